@@ -0,0 +1,220 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Headless benchmark of the parkinsons app at growing data sizes
+
+For every scale a synthetic GBD export is written (see synthetic.py), ingested with process_data and served to a
+bokeh Document without a browser, and the following are recorded:
+    ingest time and peak memory, dataset/index build time, session creation time,
+    per-frame update() latency and the bytes of the PATCH-DOC message each frame would send.
+
+Usage:
+    python benchmark.py                          # 1x, 10x and 100x the bundled incidence/prevalence file
+    python benchmark.py --scales 1 10 --save     # write results/<timestamp>.json
+    python benchmark.py --compare results/<timestamp>.json
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from os.path import abspath, dirname, join
+
+app_dir = abspath(join(dirname(__file__), '..', 'parkinsons'))
+sys.path.insert(0, app_dir)
+
+import data  # noqa: E402
+from metrics import patch_size  # noqa: E402
+from synthetic import ensure_dataset  # noqa: E402
+
+results_dir = join(dirname(__file__), 'results')
+
+# Multiples of the bundled data as (locations, years, age groups), each product is the scale
+scales = {
+    1: (1, 1, 1),
+    10: (5, 1, 2),
+    100: (5, 4, 5),
+}
+
+# Metrics where a larger value is worse, checked by --compare
+compared_metrics = ['ingest_s', 'ingest_peak_rss_mb', 'dataset_s', 'session_s',
+                    'frame_ms_p50', 'frame_ms_p95', 'patch_kb_mean']
+
+
+def ingest(data_dir, frame_path, queue):
+    '''
+    Runs process_data in a fresh process so its peak RSS is not shared with earlier scales
+    The frame is pickled to frame_path for the parent process
+    '''
+    start = time.perf_counter()
+    df, risk_list = data.process_data(data_dir)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+    df.to_pickle(frame_path)
+    queue.put((seconds, peak_mb, risk_list))
+
+
+def run_session(dataset):
+    '''
+    Creates one session of the app on the given dataset and plays every year through the year slider
+    :param dataset: data.Dataset
+    :return: session creation seconds, list of frame seconds, list of frame patch bytes
+    '''
+    from bokeh.application import Application
+    from bokeh.application.handlers import DirectoryHandler
+    from bokeh.document import Document
+    from bokeh.models import Slider
+
+    data.set_dataset(dataset)
+    app = Application(DirectoryHandler(filename=app_dir))
+
+    start = time.perf_counter()
+    doc = Document()
+    app.initialize_document(doc)
+    session_seconds = time.perf_counter() - start
+    for handler in app.handlers:
+        if handler.failed:
+            raise RuntimeError(handler.error_detail)
+
+    events = []
+    doc.on_change(events.append)
+    slider = doc.select_one({'type': Slider})
+
+    frame_seconds, frame_bytes = [], []
+    for year in dataset.years:
+        del events[:]
+        start = time.perf_counter()
+        slider.value = int(year)
+        frame_seconds.append(time.perf_counter() - start)
+        frame_bytes.append(patch_size(events))
+
+    return session_seconds, frame_seconds, frame_bytes
+
+
+def benchmark(scale, work_dir):
+    '''
+    Runs every measurement for one scale
+    :param scale: key of scales
+    :param work_dir: directory the synthetic exports are written to and reused from
+    :return: dict of metrics
+    '''
+    locations, years, ages = scales[scale]
+    data_dir = ensure_dataset(join(work_dir, 'x%d' % scale), locations, years, ages)
+    frame_path = join(data_dir, 'frame.pkl')
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=ingest, args=(data_dir, frame_path, queue))
+    process.start()
+    ingest_seconds, peak_mb, risk_list = queue.get()
+    process.join()
+
+    df = pd.read_pickle(frame_path)
+    start = time.perf_counter()
+    dataset = data.Dataset.from_frame(df, risk_list)
+    dataset_seconds = time.perf_counter() - start
+
+    session_seconds, frame_seconds, frame_bytes = run_session(dataset)
+    frame_ms = np.array(frame_seconds) * 1000
+
+    return {
+        'scale': scale,
+        'rows': len(df),
+        'ingest_s': ingest_seconds,
+        'ingest_peak_rss_mb': peak_mb,
+        'dataset_s': dataset_seconds,
+        'session_s': session_seconds,
+        'frames': len(frame_ms),
+        'frame_ms_p50': float(np.percentile(frame_ms, 50)),
+        'frame_ms_p95': float(np.percentile(frame_ms, 95)),
+        'frame_ms_max': float(frame_ms.max()),
+        'patch_kb_mean': float(np.mean(frame_bytes)) / 1024,
+    }
+
+
+def print_results(results):
+    columns = ['scale', 'rows', 'ingest_s', 'ingest_peak_rss_mb', 'dataset_s', 'session_s',
+               'frame_ms_p50', 'frame_ms_p95', 'frame_ms_max', 'patch_kb_mean']
+    print(' '.join('%18s' % name for name in columns))
+    for result in results:
+        print(' '.join('%18.4g' % result[name] for name in columns))
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints each compared metric against a saved run
+    :param results: list of metric dicts from this run
+    :param baseline: saved run, as written by --save
+    :param tolerance: allowed relative increase before a metric counts as a regression
+    :return: list of (scale, metric, old, new) regressions
+    '''
+    old_by_scale = {result['scale']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = old_by_scale.get(result['scale'])
+        if old is None:
+            continue
+        for name in compared_metrics:
+            ratio = result[name] / old[name] if old[name] else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions.append((result['scale'], name, old[name], result[name]))
+            print('x%-4d %-20s %12.4g -> %12.4g  (%5.2fx)%s' % (result['scale'], name, old[name], result[name],
+                                                                  ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=sorted(scales), choices=sorted(scales))
+    parser.add_argument('--work-dir', default=join(tempfile.gettempdir(), 'parkinsons-benchmark'),
+                        help='where synthetic exports are written and reused between runs')
+    parser.add_argument('--save', action='store_true', help='write the results to benchmarks/results')
+    parser.add_argument('--compare', help='saved results to compare against, exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase of a metric allowed by --compare (default 0.2)')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        print('x%d ...' % scale, flush=True)
+        results.append(benchmark(scale, args.work_dir))
+    print_results(results)
+
+    if args.save:
+        import bokeh
+        os.makedirs(results_dir, exist_ok=True)
+        path = join(results_dir, time.strftime('%Y%m%d-%H%M%S') + '.json')
+        with open(path, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'versions': {'bokeh': bokeh.__version__, 'numpy': np.__version__, 'pandas': pd.__version__},
+                'results': results,
+            }, f, indent=2)
+        print('saved %s' % path)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
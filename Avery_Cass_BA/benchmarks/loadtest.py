@@ -0,0 +1,328 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Load test of one `bokeh serve parkinsons` process with a growing number of simultaneous sessions
+
+A local server is started on the app (or --url points at one already running, with --pid for its CPU and
+memory). For every step of --sessions that many bokeh.client sessions are opened, each in its own thread, and
+for --duration seconds each one repeatedly:
+    moves the year slider, picks one to three countries, picks an x-axis risk, and plays the animation for --play seconds.
+Recorded per step:
+    p50/p95/p99 latency from a widget change to the new frame arriving back at the client,
+    playback frames per second (the app plays at most 2), server CPU and RSS, and sessions that failed.
+
+Usage:
+    python loadtest.py                                  # 1, 2, 4, 8 and 16 sessions
+    python loadtest.py --sessions 10 20 40 --duration 60 --save
+    python loadtest.py --url http://localhost:5006/parkinsons --pid 12345
+
+CPU and RSS are read from /proc, so they are only reported on Linux. All sessions run in this one Python process,
+so when latency grows while the server's cpu_pct stays well under 100 the load generator is the bottleneck, and
+more sessions are best added by running several copies against one --url.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import warnings
+from datetime import timedelta
+import numpy as np
+from os.path import abspath, basename, dirname, exists, join
+
+app_dir = abspath(join(dirname(__file__), '..', 'parkinsons'))
+results_dir = join(dirname(__file__), 'results')
+
+# Longest wait for a frame before the change counts as timed out
+frame_timeout = 10
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_server(app, port):
+    '''
+    Starts `bokeh serve` on the app and waits until it answers
+    :param app: app directory
+    :param port: port to serve on
+    :return: subprocess.Popen of the server and the url of the app
+    '''
+    process = subprocess.Popen([sys.executable, '-m', 'bokeh', 'serve', app, '--port', str(port),
+                                '--allow-websocket-origin', 'localhost:%d' % port],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://localhost:%d/%s' % (port, basename(app.rstrip(os.sep)))
+    for _ in range(600):
+        if process.poll() is not None:
+            raise RuntimeError('bokeh serve exited with %d' % process.returncode)
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('bokeh serve did not answer on %s' % url)
+
+
+def process_usage(pid):
+    '''
+    :param pid: process id
+    :return: cpu seconds used so far and resident memory in MB, or None when /proc is not available
+    '''
+    stat_path = '/proc/%d/stat' % pid
+    if not exists(stat_path):
+        return None
+    with open(stat_path) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open('/proc/%d/status' % pid) as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    return cpu_seconds, rss_kb / 1024
+
+
+class SessionDriver(object):
+    '''
+    One simulated viewer, driving a bokeh.client session on its own IOLoop in its own thread
+    Patches from the server are only timed, not applied: the client of bokeh 1.4 cannot decode the binary arrays
+    the server sends. The year slider, which playback moves on the server, is the only state it copies back
+    '''
+
+    def __init__(self, url, duration, play_seconds, seed):
+        self.url = url
+        self.duration = duration
+        self.play_seconds = play_seconds
+        self.random = random.Random(seed)
+        self.latencies = []
+        self.fps = []
+        self.timeouts = 0
+        self.error = None
+        self.frame_id = None
+        self.slider = None
+        self.frames = []
+
+    def run(self):
+        from bokeh.client import pull_session
+        from bokeh.util.warnings import BokehDeprecationWarning
+        from tornado.ioloop import IOLoop
+
+        # loop_until_closed is deprecated for apps, it is what keeps a headless client listening here
+        warnings.simplefilter('ignore', BokehDeprecationWarning)
+
+        try:
+            loop = IOLoop()
+            self.session = pull_session(url=self.url, io_loop=loop)
+            self.session._handle_patch = self.patch_arrived
+            loop.add_callback(self.drive)
+            self.session.loop_until_closed(suppress_warning=True)
+        except Exception as e:
+            self.error = repr(e)
+
+    def patch_arrived(self, message):
+        '''
+        Stands in for ClientSession._handle_patch, recording when the data of the frame source is replaced
+        :param message: PATCH-DOC message from the server
+        '''
+        for event in message.content['events']:
+            if event['kind'] == 'ColumnDataChanged' and event['column_source']['id'] == self.frame_id:
+                self.frames.append(time.perf_counter())
+                self.frame_event.set()
+            elif (event['kind'] == 'ModelChanged' and self.slider is not None
+                  and event['model']['id'] == self.slider.id and event['attr'] == 'value'):
+                # Set as coming from the session, so it is not sent back to the server
+                self.slider.set_from_json('value', event['new'], setter=self.session)
+
+    async def wait_for_frame(self, frames_before):
+        from tornado.util import TimeoutError
+
+        while len(self.frames) <= frames_before:
+            self.frame_event.clear()
+            try:
+                await self.frame_event.wait(timeout=timedelta(seconds=frame_timeout))
+            except TimeoutError:
+                self.timeouts += 1
+                return False
+        return True
+
+    async def change(self, model, attr, value):
+        '''
+        Sets a widget property and records the time until the next frame arrives
+        '''
+        if getattr(model, attr) == value:
+            return
+        frames_before = len(self.frames)
+        start = time.perf_counter()
+        setattr(model, attr, value)
+        if await self.wait_for_frame(frames_before):
+            self.latencies.append(self.frames[frames_before] - start)
+
+    async def play(self):
+        '''
+        Plays the animation by sending the Play button's click event, and records the frame rate
+        '''
+        import tornado.gen
+        from bokeh.protocol.messages.event import event_1
+
+        def click():
+            message = event_1(event_1.create_header(), {},
+                              json.dumps({'event_name': 'button_click', 'event_values': {'model_id': self.button.id}}))
+            # ClientSession has no public way to send events, so the message goes straight to its connection
+            self.session._connection.send_message(message)
+
+        click()
+        frames_before = len(self.frames)
+        await tornado.gen.sleep(self.play_seconds)
+        played = self.frames[frames_before:]
+        if len(played) > 2:
+            self.fps.append((len(played) - 1) / (played[-1] - played[0]))
+        click()
+        await tornado.gen.sleep(1)
+
+    async def drive(self):
+        from bokeh.models import Button, ColumnDataSource, MultiSelect, Select, Slider
+        from tornado.locks import Event
+
+        try:
+            doc = self.session.document
+            self.frame_id = doc.select_one({'type': ColumnDataSource, 'name': 'frame'}).id
+            slider = self.slider = doc.select_one({'type': Slider})
+            selects = {select.title: select for select in doc.select({'type': Select})}
+            selects.update({select.title: select for select in doc.select({'type': MultiSelect})})
+            country, risk = selects['Country Choice'], selects['X-axis Choice']
+            self.button = doc.select_one({'type': Button})
+            self.frame_event = Event()
+
+            end = time.time() + self.duration
+            while time.time() < end:
+                await self.change(slider, 'value', self.random.randint(slider.start, slider.end))
+                await self.change(country, 'value', self.random.sample(country.options, self.random.randint(1, 3)))
+                await self.change(risk, 'value', self.random.choice(risk.options))
+                await self.play()
+        except Exception as e:
+            self.error = repr(e)
+        finally:
+            self.session.close()
+
+
+def run_step(url, pid, sessions, duration, play_seconds):
+    '''
+    Drives a number of simultaneous sessions and samples the server process meanwhile
+    :return: dict of metrics
+    '''
+    drivers = [SessionDriver(url, duration, play_seconds, seed) for seed in range(sessions)]
+    threads = [threading.Thread(target=driver.run, daemon=True) for driver in drivers]
+
+    usage = [] if pid is None else [(time.time(), process_usage(pid))]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1)
+        if pid is not None:
+            usage.append((time.time(), process_usage(pid)))
+    for thread in threads:
+        thread.join()
+
+    latencies = np.array([latency for driver in drivers for latency in driver.latencies]) * 1000
+    fps = np.array([rate for driver in drivers for rate in driver.fps])
+    result = {
+        'sessions': sessions,
+        'changes': len(latencies),
+        'latency_ms_p50': float(np.percentile(latencies, 50)) if len(latencies) else float('nan'),
+        'latency_ms_p95': float(np.percentile(latencies, 95)) if len(latencies) else float('nan'),
+        'latency_ms_p99': float(np.percentile(latencies, 99)) if len(latencies) else float('nan'),
+        'play_fps_p50': float(np.percentile(fps, 50)) if len(fps) else float('nan'),
+        'play_fps_p5': float(np.percentile(fps, 5)) if len(fps) else float('nan'),
+        'timeouts': sum(driver.timeouts for driver in drivers),
+        'failed': sum(driver.error is not None for driver in drivers),
+        'cpu_pct': float('nan'),
+        'rss_mb': float('nan'),
+    }
+    for driver in drivers:
+        if driver.error is not None:
+            print('  session failed: %s' % driver.error)
+
+    samples = [(when, sample) for when, sample in usage if sample is not None]
+    if len(samples) > 1:
+        (first_time, (first_cpu, _)), (last_time, (last_cpu, _)) = samples[0], samples[-1]
+        result['cpu_pct'] = 100 * (last_cpu - first_cpu) / (last_time - first_time)
+        result['rss_mb'] = max(rss for _, (_, rss) in samples)
+    return result
+
+
+def print_results(results, min_fps):
+    columns = ['sessions', 'changes', 'latency_ms_p50', 'latency_ms_p95', 'latency_ms_p99',
+               'play_fps_p50', 'play_fps_p5', 'cpu_pct', 'rss_mb', 'timeouts', 'failed']
+    print(' '.join('%14s' % name for name in columns))
+    for result in results:
+        print(' '.join('%14.4g' % result[name] for name in columns))
+
+    # Every session, not just the typical one, should still see the frame rate
+    sustained = [result['sessions'] for result in results
+                 if result['play_fps_p5'] >= min_fps and not result['failed'] and not result['timeouts']]
+    if sustained:
+        print('Playback held %.2g fps for 95%% of sessions up to %d sessions' % (min_fps, max(sustained)))
+    else:
+        print('Playback fell below %.2g fps at every step' % min_fps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help='numbers of simultaneous sessions to run, one step each')
+    parser.add_argument('--duration', type=float, default=20, help='seconds each step runs for (default 20)')
+    parser.add_argument('--play', type=float, default=5, help='seconds of playback in each cycle (default 5)')
+    parser.add_argument('--min-fps', type=float, default=1.9,
+                        help='playback frame rate that counts as keeping up, the app plays at 2 fps (default 1.9)')
+    parser.add_argument('--app', default=app_dir, help='app directory to serve (default the parkinsons app)')
+    parser.add_argument('--url', help='app of a running server, instead of starting one')
+    parser.add_argument('--pid', type=int, help='process id of the running server given by --url')
+    parser.add_argument('--save', action='store_true', help='write the results to benchmarks/results')
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url, pid = args.url, args.pid
+    else:
+        server, url = start_server(args.app, free_port())
+        pid = server.pid
+
+    results = []
+    try:
+        for sessions in args.sessions:
+            print('%d sessions ...' % sessions, flush=True)
+            results.append(run_step(url, pid, sessions, args.duration, args.play))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print_results(results, args.min_fps)
+
+    if args.save:
+        import bokeh
+        os.makedirs(results_dir, exist_ok=True)
+        path = join(results_dir, 'loadtest-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+        with open(path, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'versions': {'bokeh': bokeh.__version__},
+                'args': vars(args),
+                'results': results,
+            }, f, indent=2)
+        print('saved %s' % path)
+
+
+if __name__ == '__main__':
+    main()
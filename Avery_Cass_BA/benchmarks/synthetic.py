@@ -0,0 +1,129 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Writes synthetic IHME GBD exports shaped like the files in parkinsons/data, at a chosen multiple of their size
+
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from os.path import dirname, exists, join
+
+sys.path.insert(0, join(dirname(__file__), '..', 'parkinsons'))
+
+from data import risk_columns, direct_columns, measure_columns, all_causes_id, parkinsons_cause_id  # noqa: E402
+
+bundled_dir = join(dirname(__file__), '..', 'parkinsons', 'data')
+
+cause_columns = ['measure_id', 'measure_name', 'location_id', 'location_name', 'sex_id', 'sex_name', 'age_id',
+                 'age_name', 'cause_id', 'cause_name', 'metric_id', 'metric_name', 'year', 'val', 'upper', 'lower']
+risk_file_columns = cause_columns[:10] + ['rei_id', 'rei_name'] + cause_columns[10:]
+
+# GBD age groups, the bundled exports only hold All Ages
+age_groups = [(22, 'All Ages'), (1, 'Under 5'), (6, '5 to 9'), (7, '10 to 14'), (8, '15 to 19'), (9, '20 to 24'),
+              (10, '25 to 29'), (11, '30 to 34'), (12, '35 to 39'), (13, '40 to 44'), (14, '45 to 49'),
+              (15, '50 to 54'), (16, '55 to 59'), (17, '60 to 64'), (18, '65 to 69'), (19, '70 to 74'),
+              (20, '75 to 79'), (30, '80 to 84'), (31, '85 to 89'), (32, '90 to 94'), (235, '95 plus')]
+
+measure_names = {3: 'YLDs (Years Lived with Disability)', 5: 'Prevalence', 6: 'Incidence'}
+
+# Bumped whenever write_dataset writes different files for the same parameters, so older datasets are rewritten
+layout_version = 2
+
+
+def grid(locations, years, ages):
+    '''
+    Builds every combination of location, sex, age and year
+    :param locations: Dataframe of location_id and location_name
+    :param years: list of years
+    :param ages: list of (age_id, age_name)
+    :return: Dataframe of the key columns
+    '''
+    n = len(locations) * 2 * len(ages) * len(years)
+    per_location = n // len(locations)
+    per_sex = per_location // 2
+    per_age = per_sex // len(ages)
+    age_ids, age_names = zip(*ages)
+    return pd.DataFrame({
+        'location_id': np.repeat(locations['location_id'].values, per_location),
+        'location_name': np.repeat(locations['location_name'].values, per_location),
+        'sex_id': np.tile(np.repeat([1, 2], per_sex), len(locations)),
+        'sex_name': np.tile(np.repeat(['Male', 'Female'], per_sex), len(locations)),
+        'age_id': np.tile(np.repeat(age_ids, per_age), len(locations) * 2),
+        'age_name': np.tile(np.repeat(age_names, per_age), len(locations) * 2),
+        'year': np.tile(years, n // len(years)),
+    })
+
+
+def with_values(keys, rng, low, high):
+    '''
+    Adds val, upper and lower columns drawn uniformly on a log scale between low and high
+    '''
+    val = np.exp(rng.uniform(np.log(low), np.log(high), len(keys)))
+    return keys.assign(val=val, upper=val * rng.uniform(1.05, 1.3, len(keys)),
+                       lower=val * rng.uniform(0.7, 0.95, len(keys)))
+
+
+def write_dataset(out_dir, locations=1, years=1, ages=1, seed=0):
+    '''
+    Writes the four source files read by data.process_data
+    Extra locations are named after a bundled country and share its region, extra years follow on from 2017
+    :param out_dir: directory to write to
+    :param locations: multiple of the bundled 195 locations
+    :param years: multiple of the bundled 28 years
+    :param ages: number of age groups, All Ages first
+    :param seed: random seed
+    :return: number of rows written to the incidence/prevalence file
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    regions = pd.read_csv(join(bundled_dir, 'region.csv'))
+    names = [country if i == 0 else '%s %d' % (country, i) for i in range(locations) for country in regions.Country]
+    groups = [group for i in range(locations) for group in regions.Group]
+    pd.DataFrame({'Country': names, 'Group': groups}).to_csv(join(out_dir, 'region.csv'), index=False)
+
+    place = pd.DataFrame({'location_id': np.arange(1, len(names) + 1), 'location_name': names})
+    keys = grid(place, list(range(1990, 1990 + 28 * years)), age_groups[:ages])
+
+    # Parkinson's incidence and prevalence, one block of rows per measure
+    path = join(out_dir, 'IHME-GBD_2017_DATA-PD_Incidence_prevalence.csv')
+    for i, (measure_id, low, high) in enumerate([(6, 1e-6, 5e-5), (5, 1e-5, 1e-3)]):
+        block = with_values(keys, rng, low, high)
+        block.insert(0, 'measure_id', measure_id)
+        block.insert(1, 'measure_name', measure_names[measure_id])
+        block = block.assign(cause_id=parkinsons_cause_id, cause_name="Parkinson's disease", metric_id=2,
+                             metric_name='Percent')
+        block[cause_columns].to_csv(path, index=False, mode='a' if i else 'w', header=not i)
+
+    # Risk files, written one risk at a time to keep memory bounded
+    for file_name, risks, cause_id, cause_name in [
+            ('IHME-GBD_2017_DATA-All-Risks.csv', risk_columns, all_causes_id, 'All causes'),
+            ('IHME-GBD_2017_DATA-direct_cause_PD.csv', direct_columns, parkinsons_cause_id, "Parkinson's disease")]:
+        path = join(out_dir, file_name)
+        for i, rei_name in enumerate(risks):
+            block = with_values(keys, rng, 1e-4, 1e-1)
+            block = block.assign(measure_id=3, measure_name=measure_names[3], cause_id=cause_id, cause_name=cause_name,
+                                 rei_id=100 + i, rei_name=rei_name, metric_id=2, metric_name='Percent')
+            block[risk_file_columns].to_csv(path, index=False, mode='a' if i else 'w', header=not i)
+
+    return len(keys) * len(measure_columns)
+
+
+def ensure_dataset(out_dir, locations=1, years=1, ages=1, seed=0):
+    '''
+    Writes the dataset unless out_dir already holds one written with the same parameters
+    :return: out_dir
+    '''
+    marker = join(out_dir, 'synthetic.txt')
+    params = 'locations=%d years=%d ages=%d seed=%d layout=%d' % (locations, years, ages, seed, layout_version)
+    if exists(marker) and open(marker).read() == params:
+        return out_dir
+
+    write_dataset(out_dir, locations, years, ages, seed)
+    with open(marker, 'w') as f:
+        f.write(params)
+    return out_dir
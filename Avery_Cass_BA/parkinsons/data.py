@@ -4,142 +4,1064 @@ Date: 14/05/2019
 Version: 2.1
 Email: averysoh@outlook.com
 
+Builds and reads the store of the IHME data the app plots, and answers queries on it without Bokeh, e.g. from a
+notebook or a batch job:
+
+    import data
+    data.frame(2017, 'Smoking', sex='Female', region='South Asia')
+    data.series('France', 'Diet high in sugar-sweetened beverages')
+
+Importing it does no work: NumPy and pandas are imported and the store opened on first use.
+
 """
 
-import numpy as np
-import pandas as pd
-from os.path import dirname, join
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from os.path import dirname, exists, isdir, join
+
+try:
+    import fcntl
+except ImportError:  # Windows, where bokeh serve cannot fork workers
+    fcntl = None
+
+
+def lazy_import(name):
+    '''
+    Returns a module that is only loaded once one of its attributes is used
+    :param name: module name
+    :return: the module, loaded already if something imported it before
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
-def process_data():
+# Risk factors taken from the all risks dataset and the column each one becomes in the merged dataset
+risk_columns = {
+    'High LDL cholesterol': 'cholesterol',
+    'High fasting plasma glucose': 'glucose',
+    'High body-mass index': 'bmi',
+    'Diet low in legumes': 'legumes',
+    'Diet low in fruits': 'fruits',
+    'Diet low in milk': 'milk',
+    'Diet low in whole grains': 'grains',
+    'Diet high in processed meat': 'processed_meat',
+    'Diet low in vegetables': 'veg',
+    'Diet high in sugar-sweetened beverages': 'sugar',
+    'Diet high in sodium': 'sodium',
+}
 
-    # Import the Risk Dataset
-    risk = pd.read_csv(join(dirname(__file__), 'data', 'IHME-GBD_2017_DATA-All-Risks.csv'))
+# Risk factors taken from the direct cause dataset
+direct_columns = {
+    'Smoking': 'smoking',
+}
 
-    # cholesterol in YLDs
-    chol = risk.loc[risk['rei_name'] == 'High LDL cholesterol']
-    chol = chol.rename(columns={'val': 'cholesterol'})
+# Every selectable risk factor and its column, all in YLDs
+risk_map = dict(risk_columns, **direct_columns)
 
-    # Fasting Plasma Glucose in YLDs
-    glucose = risk.loc[risk['rei_name'] == 'High fasting plasma glucose']
-    glucose = glucose.rename(columns={'val': 'glucose'})
+# Risk plotted when a session opens, loaded with the dataset
+default_risk = 'Diet high in sugar-sweetened beverages'
 
-    # High body-mass index in YLDs
-    bmi = risk.loc[risk['rei_name'] == 'High body-mass index']
-    bmi = bmi.rename(columns={'val': 'bmi'})
+# Number of risk and interval columns kept loaded, the others are read again the next time they are plotted
+risk_cache_size = 6
 
-    # Diet low in legumes in YLDs
-    legumes = risk.loc[risk['rei_name'] == 'Diet low in legumes']
-    legumes = legumes.rename(columns={'val': 'legumes'})
+# Number of prepared frames kept for every session of a process to reuse, see Dataset.frame_cache
+frame_cache_size = int(os.environ.get('PARKINSONS_FRAME_CACHE', 256))
 
-    # Diet low in fruits in YLDs
-    fruits = risk.loc[risk['rei_name'] == 'Diet low in fruits']
-    fruits = fruits.rename(columns={'val': 'fruits'})
+# Parkinson's measures taken from the cause dataset, keyed by measure_id
+measure_columns = {
+    5: 'prevalence',  # Prevalence of Parkinsons
+    6: 'incidence',  # Incidence of Parkinsons
+}
 
-    # Diet low in milk in YLDs
-    milk = risk.loc[risk['rei_name'] == 'Diet low in milk']
-    milk = milk.rename(columns={'val': 'milk'})
+# GBD reuses country names for subnational locations, e.g. Georgia, so rows are told apart by location_id
+key_columns = ['location_id', 'location_name', 'sex_name', 'age_name', 'year']
 
-    # Diet low in whole grains in YLDs
-    grains = risk.loc[risk['rei_name'] == 'Diet low in whole grains']
-    grains = grains.rename(columns={'val': 'grains'})
+# Measures whose 95% uncertainty interval is kept, each as a <measure>_lower and <measure>_upper column
+interval_measures = ['incidence']
+interval_columns = [measure + '_' + bound for measure in interval_measures for bound in ['lower', 'upper']]
 
-    # Diet high in processed meat in YLDs
-    meat = risk.loc[risk['rei_name'] == 'Diet high in processed meat']
-    meat = meat.rename(columns={'val': 'processed_meat'})
+# Columns loaded only when used rather than with the store
+lazy_columns = list(risk_map.values()) + interval_columns
 
-    # Diet low in vegetables in YLDs
-    veg = risk.loc[risk['rei_name'] == 'Diet low in vegetables']
-    veg = veg.rename(columns={'val': 'veg'})
+# Measures every risk is correlated and regressed against by risk_statistics
+statistics_measures = ['incidence', 'prevalence']
 
-    # Diet high in sugar-sweetened beverages in YLDs
-    sugar = risk.loc[risk['rei_name'] == 'Diet high in sugar-sweetened beverages']
-    sugar = sugar.rename(columns={'val': 'sugar'})
+# Rows of the exports the app plots, full GBD exports also hold the Number and Rate metrics
+percent_metric_id = 2
 
-    # Diet high in sodium in YLDs
-    sodium = risk.loc[risk['rei_name'] == 'Diet high in sodium']
-    sodium = sodium.rename(columns={'val': 'sodium'})
+# Measure the risks are attributed in, full GBD exports also hold Deaths, DALYs and YLLs for the same rows
+yld_measure_id = 3
 
-    # Merge risk dataset
-    df_risk = pd.merge(chol[['location_name', 'sex_name', 'year', 'cholesterol']],
-                       glucose[['location_name', 'sex_name', 'year', 'glucose']],
-                       on=['location_name', 'sex_name', 'year'])
+# Causes the exports are filtered on, full GBD exports can hold several for the same rows
+# The all risks dataset is attributed to every cause, the direct cause and Parkinson's datasets to Parkinson's
+all_causes_id = 294
+parkinsons_cause_id = 544
 
-    df_risk = pd.merge(df_risk,
-                       bmi[['location_name', 'sex_name', 'year', 'bmi']],
-                       on=['location_name', 'sex_name', 'year'])
+# How each IHME export is read, as the label_column, labels, intervals and where arguments of read_export
+export_reads = {
+    'IHME-GBD_2017_DATA-All-Risks.csv':
+        ('rei_name', risk_columns, (), {'measure_id': yld_measure_id, 'cause_id': all_causes_id}),
+    'IHME-GBD_2017_DATA-direct_cause_PD.csv':
+        ('rei_name', direct_columns, (), {'measure_id': yld_measure_id, 'cause_id': parkinsons_cause_id}),
+    'IHME-GBD_2017_DATA-PD_Incidence_prevalence.csv':
+        ('measure_id', measure_columns, interval_measures, {'cause_id': parkinsons_cause_id}),
+}
 
-    df_risk = pd.merge(df_risk,
-                       legumes[['location_name', 'sex_name', 'year', 'legumes']],
-                       on=['location_name', 'sex_name', 'year'])
+# Age group shown when a session opens, the bundled exports only hold this one
+all_ages = 'All Ages'
 
-    df_risk = pd.merge(df_risk,
-                       fruits[['location_name', 'sex_name', 'year', 'fruits']],
-                       on=['location_name', 'sex_name', 'year'])
+# Location levels, countries are listed in region.csv and subnational locations in the optional subnational.csv
+country_level = 'Country'
+subnational_level = 'Subnational'
+location_levels = [country_level, subnational_level]
 
-    df_risk = pd.merge(df_risk,
-                       milk[['location_name', 'sex_name', 'year', 'milk']],
-                       on=['location_name', 'sex_name', 'year'])
+# Columns read from the exports and the dtype each is parsed as, everything else is skipped while reading
+read_dtypes = {
+    'measure_id': 'int16',
+    'location_id': 'int32',
+    'location_name': 'category',
+    'sex_name': 'category',
+    'age_name': 'category',
+    'rei_name': 'category',
+    'cause_id': 'int16',
+    'metric_id': 'int16',
+    'year': 'int16',
+    'val': 'float32',
+    'lower': 'float32',
+    'upper': 'float32',
+}
 
-    df_risk = pd.merge(df_risk,
-                       grains[['location_name', 'sex_name', 'year', 'grains']],
-                       on=['location_name', 'sex_name', 'year'])
+# Rows parsed at a time, bounds the memory used for reading whatever the size of the export
+chunk_rows = 500000
 
-    df_risk = pd.merge(df_risk,
-                       meat[['location_name', 'sex_name', 'year', 'processed_meat']],
-                       on=['location_name', 'sex_name', 'year'])
+# Directory of the exports, PARKINSONS_DATA_DIR serves exports kept elsewhere, e.g. those preprocess.py --data-dir read
+data_dir = os.environ.get('PARKINSONS_DATA_DIR', join(dirname(__file__), 'data'))
 
-    df_risk = pd.merge(df_risk,
-                       veg[['location_name', 'sex_name', 'year', 'veg']],
-                       on=['location_name', 'sex_name', 'year'])
+# Input files read by process_data, their fingerprints decide whether the store is still valid
+# subnational.csv maps the location_id of each subnational Location to its Country and may be left out
+source_files = [
+    'IHME-GBD_2017_DATA-All-Risks.csv',
+    'IHME-GBD_2017_DATA-direct_cause_PD.csv',
+    'IHME-GBD_2017_DATA-PD_Incidence_prevalence.csv',
+    'region.csv',
+    'subnational.csv',
+]
 
-    df_risk = pd.merge(df_risk,
-                       sugar[['location_name', 'sex_name', 'year', 'sugar']],
-                       on=['location_name', 'sex_name', 'year'])
+# Year-partitioned store of the processed dataset, written by preprocess.py or on first load
+# Kept in the data directory unless PARKINSONS_STORE names another, e.g. the one preprocess.py --store wrote
+# Bump store_version whenever its layout or the output of process_data changes
+store_dir = os.environ.get('PARKINSONS_STORE', join(data_dir, 'store'))
+store_version = 8
 
-    df_risk = pd.merge(df_risk,
-                       sodium[['location_name', 'sex_name', 'year', 'sodium']],
-                       on=['location_name', 'sex_name', 'year'])
+# Directory of the store keeping the parsed rows of each export, by content hash, so a rebuild only parses the
+# exports that changed
+parsed_dir = 'parsed'
 
-    # Import the Direct Risk Dataset
-    direct = pd.read_csv(join(dirname(__file__), 'data', 'IHME-GBD_2017_DATA-direct_cause_PD.csv'))
+# Seconds between checks of the source files by a running server, 0 turns reloading off
+reload_interval = float(os.environ.get('PARKINSONS_RELOAD_INTERVAL', 5))
 
-    # Smoking in YLDs
-    smoking = direct.loc[direct['rei_name'] == 'Smoking']
-    smoking = smoking.rename(columns={'val': 'smoking'})
+# Columns stored as integer codes into the sorted array of their values
+encoded_columns = ['location_name', 'sex_name', 'age_name', 'regions', 'level']
 
-    df_risk = pd.merge(df_risk,
-                       smoking[['location_name', 'sex_name', 'year', 'smoking']],
-                       on=['location_name', 'sex_name', 'year'])
+# Setting the size factor of each point
+scale_factor = 1100
 
-    # Import the Parkinson's prevalence dataset
-    cause = pd.read_csv(join(dirname(__file__), 'data', 'IHME-GBD_2017_DATA-PD_Incidence_prevalence.csv'))
-    pv = cause.loc[cause["measure_id"] == 5]  # Prevalence of Parkinsons
-    pv = pv.rename(columns={"val": "prevalence"})
+# Threads slicing frames for the sessions of a process, so the event loop serving their websockets is not held up
+# Threads rather than processes, the dataset is shared in memory and frames are handed back without pickling
+frame_workers = int(os.environ.get('PARKINSONS_FRAME_WORKERS', min(4, os.cpu_count() or 1)))
 
-    incidence = cause.loc[cause["measure_id"] == 6]  # Incidence of Parkinsons
-    incidence = incidence.rename(columns={"val": "incidence"})
+log = logging.getLogger('parkinsons.data')
 
-    df = pd.merge(df_risk,
-                  pv[['location_name', 'sex_name', 'year', 'prevalence']],
-                  on=['location_name', 'sex_name', 'year'])
 
-    df = pd.merge(df,
-                  incidence[['location_name', 'sex_name', 'year', 'incidence']],
-                  on=['location_name', 'sex_name', 'year'])
+def process_data(data_dir=data_dir, cache_dir=None, sources=None):
+    '''
+    Reads the IHME datasets and builds one row per location, sex, age group and year with a column per measure
+    Text columns are categorical, measures float32 and the year int16
+    All sources are tagged with their target column, concatenated and pivoted to the wide layout in a single pass
+    :param data_dir: directory holding the source_files, the bundled data directory by default
+    :param cache_dir: directory to keep the parsed rows of each export in, or None to always parse them
+    :param sources: fingerprints of the source files, needed with cache_dir
+    :return: the merged Dataframe and the sorted list of risk names
+    '''
+    # Stream the Risk, Direct Risk and Parkinson's prevalence datasets, keeping the rows of each wanted measure
+    long = pd.concat([parsed_export(data_dir, name, cache_dir, sources) for name in export_reads], ignore_index=True)
+
+    # Pivot to the wide layout, keeping only rows with every measure present as the inner merges did
+    # Bounds missing from the exports are left NaN, the overlay then leaves those rows out but they are still plotted
+    df = long.set_index(key_columns + ['column'])['val'].unstack('column')
+    df = df.reindex(columns=list(risk_map.values()) + list(measure_columns.values()) + interval_columns)
+    df = df.dropna(subset=list(risk_map.values()) + list(measure_columns.values())).astype('float32')
+    df.columns.name = None
+    df = df.reset_index()
+    df['year'] = df['year'].astype('int16')
 
     # Import the region dataset
-    regions = pd.read_csv(join(dirname(__file__), 'data', 'region.csv'))
+    regions = pd.read_csv(join(data_dir, 'region.csv'))
     regions.rename({'Country': 'location_name'}, axis='columns', inplace=True)
     regions.rename({'Group': 'regions'}, axis='columns', inplace=True)
+    region_map = regions.set_index('location_name')['regions']
+
+    # Attach the regions and levels, countries by name
+    df['regions'] = df['location_name'].map(region_map).astype(object)
+    df['level'] = country_level
+
+    # Subnational locations by location_id, taking the region of their country
+    # Those named like a country are named after their country as well, e.g. Georgia (United States)
+    if exists(join(data_dir, 'subnational.csv')):
+        subnational = pd.read_csv(join(data_dir, 'subnational.csv')).set_index('location_id')['Country']
+        rows = df['location_id'].isin(subnational.index)
+        country = df.loc[rows, 'location_id'].map(subnational)
+        df.loc[rows, 'regions'] = country.map(region_map)
+        df.loc[rows, 'level'] = subnational_level
+        clashes = rows & df['location_name'].isin(region_map.index)
+        df.loc[clashes, 'location_name'] = (df.loc[clashes, 'location_name'] + ' ('
+                                            + df.loc[clashes, 'location_id'].map(subnational) + ')')
+
+    # Drop locations without a region
+    df = df.dropna(subset=['regions']).drop(columns='location_id').reset_index(drop=True)
 
-    # Merge the data and create a single df
-    df = pd.merge(df,
-                  regions,
-                  on="location_name")
+    # Text columns repeat a few hundred values, hold them as categoricals
+    for name in encoded_columns:
+        df[name] = df[name].astype('category')
 
-    a = ['Smoking']
-    a.extend(risk.rei_name.unique())
-    risk_list = sorted(a)
+    risk_list = sorted(risk_map)
 
     return df, risk_list
+
+
+def read_export(path, label_column, labels, intervals=(), where=None):
+    '''
+    Reads an IHME export in chunks, keeping only the columns and rows the app uses
+    Rows of every age group are kept in percent when label_column holds one of the labels
+    :param path: path of the csv export
+    :param label_column: column naming the measure of each row, 'rei_name' or 'measure_id'
+    :param labels: dict mapping the wanted values of label_column to the column they become in the merged dataset
+    :param intervals: columns whose lower and upper bounds are kept as well, as rows of <column>_lower and
+                      <column>_upper, when the export has the lower and upper columns
+    :param where: dict of the value rows must hold in other columns, e.g. {'measure_id': yld_measure_id},
+                  columns the export does not have are not filtered on
+    :return: long Dataframe of location_id, location_name, sex_name, age_name, year, column and val,
+             location_id being -1 if the export does not have it
+    '''
+    header = pd.read_csv(path, nrows=0).columns
+    # Bounds are only read when the export holds both of them
+    intervals = intervals if {'lower', 'upper'}.issubset(header) else ()
+    usecols = [name for name in read_dtypes if name in header and (intervals or name not in ('lower', 'upper'))]
+    dtypes = {name: read_dtypes[name] for name in usecols}
+
+    kept = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=dtypes, chunksize=chunk_rows):
+        column = chunk[label_column].map(labels)
+        rows = column.notna()
+        for name, value in dict(where or {}, metric_id=percent_metric_id).items():
+            if name in chunk:
+                rows &= chunk[name] == value
+
+        chunk = chunk.loc[rows]
+        column = column.loc[rows].astype(object)
+        keys = {
+            'location_id': chunk['location_id'] if 'location_id' in chunk else np.int32(-1),
+            'location_name': chunk['location_name'].astype(object),
+            'sex_name': chunk['sex_name'].astype(object),
+            'age_name': chunk['age_name'].astype(object),
+            'year': chunk['year'],
+        }
+        kept.append(pd.DataFrame(dict(keys, column=column, val=chunk['val'])))
+
+        # Bounds are tagged like any other measure, so the pivot lines them up with their values
+        bounded = column.isin(intervals)
+        if bounded.any():
+            for bound in ['lower', 'upper']:
+                kept.append(pd.DataFrame(dict(keys, column=column + '_' + bound, val=chunk[bound])).loc[bounded])
+
+    return pd.concat(kept, ignore_index=True)
+
+
+def read_source(name, data_dir=data_dir):
+    '''
+    Reads one IHME export with the rows process_data keeps, e.g. to look at them from a notebook
+    :param name: file name of the export, a key of export_reads
+    :param data_dir: directory holding the source_files
+    :return: long Dataframe from read_export
+    '''
+    return read_export(join(data_dir, name), *export_reads[name])
+
+
+def parsed_export(data_dir, name, cache_dir=None, sources=None):
+    '''
+    read_source of one source file, kept in cache_dir under the hash of the file so an unchanged export is only
+    parsed once whichever other source file changes
+    :param data_dir: directory holding the source_files
+    :param name: file name of the export, a key of export_reads
+    :param cache_dir: directory to keep the parsed rows in, or None to always parse the export
+    :param sources: fingerprints of the source files, needed with cache_dir
+    :return: long Dataframe from read_export
+    '''
+    fingerprint = (sources or {}).get(name)
+    if cache_dir is None or not fingerprint:
+        return read_source(name, data_dir)
+
+    # Rows parsed for an older store_version may lack columns read now
+    path = join(cache_dir, '%s.%s.v%d.pkl' % (name, fingerprint['sha1'], store_version))
+    try:
+        return pd.read_pickle(path)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    long = read_source(name, data_dir)
+
+    # Written under a temporary name and renamed, so a reader never sees half a file, then older versions are dropped
+    os.makedirs(cache_dir, exist_ok=True)
+    long.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    for old in os.listdir(cache_dir):
+        if old.startswith(name + '.') and join(cache_dir, old) != path:
+            os.remove(join(cache_dir, old))
+    return long
+
+
+def file_fingerprint(path, known=None):
+    '''
+    Describes an input file by size, modification time and content hash
+    The hash is only recomputed when the size or modification time differ from a known fingerprint
+    :param path: path of the file
+    :param known: fingerprint previously recorded for the same file, or None
+    :return: dict with size, mtime and sha1, or None if there is no such file
+    '''
+    if not exists(path):
+        return None
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if known and known['size'] == fingerprint['size'] and known['mtime'] == fingerprint['mtime']:
+        fingerprint['sha1'] = known['sha1']
+        return fingerprint
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+def partition_data(df):
+    '''
+    Lays the dataset out as one array per column, sorted by age group, location level, year, location and sex so
+    every frame is a contiguous block of rows and every country a contiguous block within its frame.
+    Text columns are dictionary-encoded
+    :param df: Dataframe from process_data
+    :return: dict of column arrays and dict of the values behind each encoded column
+    '''
+    df = df.sort_values(['age_name', 'level', 'year', 'location_name', 'sex_name'], kind='mergesort')
+
+    columns, dictionaries = {}, {}
+    for name in df.columns:
+        if name in encoded_columns:
+            codes, values = pd.factorize(df[name], sort=True)
+            columns[name] = codes.astype(np.min_scalar_type(len(values)))
+            dictionaries[name] = np.asarray(values, dtype=object)
+        else:
+            columns[name] = df[name].to_numpy()
+
+    columns['parkinsons_size'] = 10 * (scale_factor * (columns['prevalence']))
+
+    return columns, dictionaries
+
+
+def x_extent(values):
+    '''
+    Works out the x-axis range shown for a risk column
+    :param values: array of the risk values
+    :return: tuple of the range start and end
+    '''
+    low, high = float(values.min()), float(values.max())
+    return 0.15*(10**low - 1), 0.3*(10**high + 0.1)
+
+
+def describe(columns, dictionaries):
+    '''
+    Works out what a Dataset needs to know about its columns up front, so a memory-mapped store never reads them whole
+    :param columns: dict of column arrays from partition_data
+    :param dictionaries: dict of the values behind each encoded column
+    :return: dict with the [age group, level, year, start, stop] rows of every frame, the x-axis extent of every risk
+             and the y-axis extent of every age group
+    '''
+    ages, levels, years = columns['age_name'], columns['level'], columns['year']
+
+    # A frame starts wherever the age group, level or year differs from the row before
+    changed = (ages[1:] != ages[:-1]) | (levels[1:] != levels[:-1]) | (years[1:] != years[:-1])
+    starts = np.flatnonzero(np.concatenate([[len(years) > 0], changed]))
+    stops = list(starts[1:]) + [len(years)]
+
+    y_ranges = {}
+    if len(starts):
+        for start, highest in zip(starts, np.maximum.reduceat(columns['incidence'], starts)):
+            age = dictionaries['age_name'][ages[start]]
+            y_ranges[age] = (0, max(float(highest) * 1.1, y_ranges.get(age, (0, 0))[1]))
+
+    return {
+        'frame_rows': [[dictionaries['age_name'][ages[start]], dictionaries['level'][levels[start]],
+                        int(years[start]), int(start), int(stop)] for start, stop in zip(starts, stops)],
+        'x_ranges': {column: x_extent(columns[column]) for column in risk_map.values()},
+        'y_ranges': y_ranges,
+    }
+
+
+def group_sums(values, groups, size):
+    '''
+    Sums every row of a 2d array within groups, all rows in one bincount
+    :param values: array of shape (rows of values, dataset rows)
+    :param groups: group of every dataset row
+    :param size: number of groups
+    :return: array of shape (rows of values, size)
+    '''
+    keys = (np.arange(len(values))[:, None] * size + groups).ravel()
+    return np.bincount(keys, values.ravel(), minlength=len(values) * size).reshape(len(values), size)
+
+
+def risk_statistics(columns, dictionaries, load_column=None):
+    '''
+    Cross-location correlation and regression slope of every risk against every measure of statistics_measures,
+    for every age group, location level, year and sex. Rows are grouped by those four and every sum is taken for all
+    risks at once, so the whole table is a handful of vectorized passes over the dataset
+    :param columns: dict of column arrays from partition_data
+    :param dictionaries: dict of the values behind each encoded column
+    :param load_column: function returning a risk column missing from columns
+    :return: float32 array indexed by [correlation or slope, risk in risk_map order, measure, age group code,
+             level code, year from the first, sex code], NaN where fewer than three locations have data
+    '''
+    load_column = load_column or columns.__getitem__
+    years, year_index = np.unique(columns['year'], return_inverse=True)
+    shape = (len(dictionaries['age_name']), len(dictionaries['level']), len(years), len(dictionaries['sex_name']))
+    size = int(np.prod(shape))
+    groups = np.ravel_multi_index((columns['age_name'], columns['level'], year_index, columns['sex_name']), shape)
+    counts = np.bincount(groups, minlength=size)
+
+    # Deviations from the mean of each group, taken before multiplying to keep the sums accurate
+    x = np.stack([load_column(column) for column in risk_map.values()]).astype(np.float64)
+    y = np.stack([columns[measure] for measure in statistics_measures]).astype(np.float64)
+    x -= (group_sums(x, groups, size) / np.maximum(counts, 1))[:, groups]
+    y -= (group_sums(y, groups, size) / np.maximum(counts, 1))[:, groups]
+
+    sxx = group_sums(x * x, groups, size)[:, None]
+    syy = group_sums(y * y, groups, size)[None]
+    sxy = np.stack([group_sums(x * y[measure], groups, size) for measure in range(len(y))], axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistics = np.stack([sxy / np.sqrt(sxx * syy), sxy / sxx])
+    statistics[..., counts < 3] = np.nan
+    statistics[~np.isfinite(statistics)] = np.nan
+    return statistics.astype(np.float32).reshape(statistics.shape[:3] + shape)
+
+
+def age_order(age):
+    '''
+    Sort key putting All Ages first and the age bands in order of their lower bound, 'Under 5' being 0
+    '''
+    if age == all_ages:
+        return -1
+    bound = re.match(r'\d+', age)
+    return int(bound.group()) if bound else 0
+
+
+class ColumnCache(object):
+    '''
+    Bounded least recently used cache of columns, shared by the sessions of a process
+    '''
+
+    def __init__(self, load, size):
+        '''
+        :param load: function returning the array of a column from its name, or None to pass one to every get
+        :param size: number of columns kept
+        '''
+        self.load = load
+        self.size = size
+        self._columns = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, load=None):
+        '''
+        :param name: column name, or any hashable key
+        :param load: function returning the value of name when it is not cached, self.load by default
+        :return: the cached or loaded value
+        '''
+        load = load or self.load
+        with self._lock:
+            values = self._columns.get(name)
+            if values is not None:
+                self._columns.move_to_end(name)
+                return values
+
+            # Threads asking for a value already being loaded wait for it rather than loading it again
+            loading = self._loading.get(name)
+            if loading is None:
+                self._loading[name] = threading.Event()
+
+        if loading is not None:
+            loading.wait()
+            with self._lock:
+                values = self._columns.get(name)
+            return values if values is not None else load(name)
+
+        # Loaded outside the lock so a slow read does not hold up sessions plotting a cached column
+        try:
+            values = load(name)
+            with self._lock:
+                self._columns[name] = values
+                self._columns.move_to_end(name)
+                while len(self._columns) > self.size:
+                    self._columns.popitem(last=False)
+        finally:
+            with self._lock:
+                self._loading.pop(name).set()
+        return values
+
+
+class Dataset(object):
+    '''
+    The processed dataset and everything derived from it that sessions only ever read
+    One instance is built per server process by get_dataset and shared by every Bokeh session
+    '''
+
+    def __init__(self, columns, dictionaries, risk_list, layout=None, load_column=None, statistics=None):
+        '''
+        :param columns: dict of read-only column arrays from partition_data, in memory or memory-mapped
+        :param dictionaries: dict of the values behind each encoded column
+        :param risk_list: sorted list of risk names
+        :param layout: dict from describe, worked out from the columns when None
+        :param load_column: function returning a risk column missing from columns, e.g. read from the store
+        :param statistics: array from risk_statistics, worked out from the columns when None
+        '''
+        layout = layout or describe(columns, dictionaries)
+
+        # Store version and source fingerprints the dataset was opened from, None when built in memory
+        self.directory = layout.get('directory')
+        self.sources = layout.get('sources')
+
+        # Risk and interval columns are kept apart and only loaded once plotted, starting with the default risk
+        lazy_names = set(lazy_columns)
+        self.columns = {name: values for name, values in columns.items() if name not in lazy_names}
+        if load_column is None:
+            load_column = {name: values for name, values in columns.items() if name in lazy_names}.__getitem__
+        if statistics is None:
+            statistics = risk_statistics(columns, dictionaries, load_column)
+        self.statistics = statistics
+        self._statistics_data = {}
+        self._aligned_rows = {}
+        self.risk_cache = ColumnCache(load_column, risk_cache_size)
+        self.risk_cache.get(risk_map[default_risk])
+
+        # Frames prepared for a session are kept for the others, e.g. the default animation played by every viewer
+        self.frame_cache = ColumnCache(None, frame_cache_size)
+
+        self.dictionaries = dictionaries
+        self.risk_list = risk_list
+        self.regions = list(dictionaries['regions'])
+        self.countries = list(dictionaries['location_name'])
+        self.country_codes = {country: code for code, country in enumerate(self.countries)}
+
+        # Each age group, level and year is one block of rows, so a frame is a slice
+        # and so are all the years of one age group and level
+        self.frame_rows, self.block_rows = {}, {}
+        for age, level, year, start, stop in layout['frame_rows']:
+            self.frame_rows[age, level, year] = (start, stop)
+            first, last = self.block_rows.get((age, level), (start, stop))
+            self.block_rows[age, level] = (min(first, start), max(last, stop))
+        self.years = sorted({year for _, _, year in self.frame_rows})
+        self.ages = sorted({age for age, _ in self.block_rows}, key=age_order)
+        self.levels = [level for level in location_levels if any(key[1] == level for key in self.block_rows)]
+
+        # Rows of every age group, country and sex in year order, so the path of a country through the years
+        # is a lookup
+        locations, sexes = len(dictionaries['location_name']), len(dictionaries['sex_name'])
+        keys = ((self.columns['age_name'].astype(np.int64) * locations + self.columns['location_name']) * sexes
+                + self.columns['sex_name'])
+        order = np.argsort(keys, kind='stable')
+        series_keys, starts = np.unique(keys[order], return_index=True)
+        stops = list(starts[1:]) + [len(order)]
+        self.country_series = {}
+        for key, start, stop in zip(series_keys, starts, stops):
+            age, location = divmod(int(key) // sexes, locations)
+            self.country_series.setdefault((dictionaries['age_name'][age], location), []).append(order[start:stop])
+
+        # Axis extents, the x-axis for every risk and the y-axis from incidence, worked out once
+        self.x_ranges = {column: tuple(extent) for column, extent in layout['x_ranges'].items()}
+        self.y_ranges = {age: tuple(extent) for age, extent in layout['y_ranges'].items()}
+        self.y_range = self.y_ranges.get(all_ages, (0, 1))
+
+    @classmethod
+    def from_frame(cls, df, risk_list):
+        '''
+        Builds a Dataset held in memory from the output of process_data
+        '''
+        columns, dictionaries = partition_data(df)
+        for values in columns.values():
+            values.flags.writeable = False
+        return cls(columns, dictionaries, risk_list)
+
+    def risk_column(self, column):
+        '''
+        :param column: risk column from risk_map, or interval column
+        :return: array of the column for every row, loaded on first use
+        '''
+        return self.risk_cache.get(column)
+
+    def rows(self, rows, risk=None, intervals=False):
+        '''
+        :param rows: slice or array of row positions
+        :param risk: risk column to include, or None
+        :param intervals: include the interval_columns
+        :return: dict of column arrays for those rows, with the encoded columns turned back into their values
+        '''
+        data = {}
+        for name, values in self.columns.items():
+            values = values[rows]
+            if name in self.dictionaries:
+                values = self.dictionaries[name][values]
+            data[name] = values
+        if risk is not None:
+            data[risk] = self.risk_column(risk)[rows]
+        if intervals:
+            for name in interval_columns:
+                data[name] = self.risk_column(name)[rows]
+        return data
+
+    def statistics_data(self, age=all_ages, level=country_level):
+        '''
+        Lays the risk statistics of one age group and level out for a heatmap, built once and shared by every session
+        :param age: age group
+        :param level: location level
+        :return: dict of arrays with a row per risk, year and sex, holding the risk name, year, sex_name and a
+                 correlation and slope column for every measure of statistics_measures
+        '''
+        key = (age, level)
+        if key not in self._statistics_data:
+            age_code = list(self.dictionaries['age_name']).index(age)
+            level_code = list(self.dictionaries['level']).index(level)
+            block = self.statistics[:, :, :, age_code, level_code]
+
+            # Rows ordered by risk, then year, then sex, the order the statistics are stored in
+            risks, sexes = np.array(list(risk_map), dtype=object), self.dictionaries['sex_name']
+            data = {
+                'risk': np.repeat(risks, len(self.years) * len(sexes)),
+                'year': np.tile(np.repeat(np.array(self.years, dtype=np.int16), len(sexes)), len(risks)),
+                'sex_name': np.tile(sexes, len(risks) * len(self.years)),
+            }
+            for measure_index, measure in enumerate(statistics_measures):
+                data['correlation_' + measure] = block[0, :, measure_index].ravel()
+                data['slope_' + measure] = block[1, :, measure_index].ravel()
+            self._statistics_data[key] = data
+        return self._statistics_data[key]
+
+    def year_data(self, year, risk=None, age=all_ages, level=country_level, intervals=False):
+        '''
+        :param year: year, or None for every year
+        :param risk: risk column to include, or None
+        :param age: age group
+        :param level: location level
+        :param intervals: include the interval_columns
+        :return: dict of column arrays for every location and sex of one age group and level in one year,
+                 empty if there are no rows
+        '''
+        if year is None:
+            start, stop = self.block_rows.get((age, level), (0, 0))
+        else:
+            start, stop = self.frame_rows.get((age, level, year), (0, 0))
+        return self.rows(slice(start, stop), risk, intervals)
+
+    def aligned_rows(self, age=all_ages, level=country_level):
+        '''
+        Lines the rows of every year of one age group and level up on one set of slots, a slot per location and sex,
+        so consecutive years can be tweened position by position. Worked out in one pass and kept for every session
+        :param age: age group
+        :param level: location level
+        :return: array of shape (years, slots) of row positions, -1 where a year has no row for the slot,
+                 and array of a row of each slot in any year
+        '''
+        key = (age, level)
+        if key not in self._aligned_rows:
+            start, stop = self.block_rows.get(key, (0, 0))
+            sexes = len(self.dictionaries['sex_name'])
+            slots = (self.columns['location_name'][start:stop].astype(np.int64) * sexes
+                     + self.columns['sex_name'][start:stop])
+            slot_keys, slot_index = np.unique(slots, return_inverse=True)
+            year_index = np.searchsorted(self.years, self.columns['year'][start:stop])
+
+            aligned = np.full((len(self.years), len(slot_keys)), -1, dtype=np.intp)
+            aligned[year_index, slot_index] = np.arange(start, stop)
+            self._aligned_rows[key] = (aligned, aligned.max(axis=0))
+        return self._aligned_rows[key]
+
+    def aligned_data(self, year, risk=None, age=all_ages, level=country_level):
+        '''
+        :param year: year
+        :param risk: risk column to include, or None
+        :param age: age group
+        :param level: location level
+        :return: dict of column arrays for one year with a row per slot of aligned_rows, the measures and risk
+                 being NaN for locations without data that year
+        '''
+        aligned, any_row = self.aligned_rows(age, level)
+        rows = aligned[self.years.index(year)] if year in self.years else np.full(len(any_row), -1)
+        data = self.rows(np.where(rows >= 0, rows, any_row), risk)
+        for name in list(measure_columns.values()) + ['parkinsons_size', risk]:
+            if name is not None:
+                data[name] = np.where(rows >= 0, data[name], np.nan).astype(data[name].dtype)
+        return data
+
+    def country_rows(self, countries, first_year=None, last_year=None, age=all_ages):
+        '''
+        Looks countries up in the per-country index
+        :param countries: list of location_name
+        :param first_year: first year, or None to start from the first year of the data
+        :param last_year: last year, or None to run to the last year of the data
+        :param age: age group
+        :return: array of the row positions of each country and sex in year order, and array of the row of the year
+                 before each of them, the row itself for the first year of the data
+        '''
+        years = self.columns['year']
+        rows, previous = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+        for country in countries:
+            for series in self.country_series.get((age, self.country_codes.get(country)), []):
+                series_years = years[series]
+                first = 0 if first_year is None else np.searchsorted(series_years, first_year)
+                last = len(series) if last_year is None else np.searchsorted(series_years, last_year, side='right')
+                rows.append(series[first:last])
+                previous.append(series[np.maximum(np.arange(first, last) - 1, 0)])
+        return np.concatenate(rows), np.concatenate(previous)
+
+
+@contextmanager
+def store_lock(path=store_dir):
+    '''
+    Holds an exclusive lock on the store, so `bokeh serve --num-procs` workers starting together build it only once
+    :param path: store directory
+    '''
+    os.makedirs(path, exist_ok=True)
+    with open(join(path, '.lock'), 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def write_manifest(manifest, path=store_dir):
+    '''
+    Replaces manifest.json in one rename, so readers see either the old store or the new one
+    '''
+    tmp_path = join(path, 'manifest.json.%d.tmp' % os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, join(path, 'manifest.json'))
+
+
+def write_store(columns, dictionaries, risk_list, sources, path=store_dir, data_dir=None):
+    '''
+    Writes the partitioned dataset as one .npy file per column into a new version directory of the store,
+    then points manifest.json at it and removes the older versions but the one it replaces
+    Processes still on the replaced version keep reading it, including risk columns they have not opened yet
+    :param columns: dict of column arrays from partition_data
+    :param dictionaries: dict of the values behind each encoded column
+    :param risk_list: sorted list of risk names
+    :param sources: dict of the fingerprint of every source file
+    :param path: store directory
+    :param data_dir: directory the source files were read from, recorded in the manifest
+    :return: the manifest
+    '''
+    try:
+        with open(join(path, 'manifest.json')) as f:
+            replaced = json.load(f).get('directory')
+    except (OSError, ValueError):
+        replaced = None
+
+    version = 'v%d' % time.time_ns()
+    version_dir = join(path, version)
+    os.makedirs(version_dir)
+
+    for name, values in columns.items():
+        np.save(join(version_dir, name + '.npy'), np.ascontiguousarray(values))
+    for name, values in dictionaries.items():
+        np.save(join(version_dir, name + '.values.npy'), values.astype(str))
+    np.save(join(version_dir, 'statistics.npy'), risk_statistics(columns, dictionaries))
+
+    manifest = dict(describe(columns, dictionaries), version=store_version, directory=version, sources=sources,
+                    risk_list=risk_list, columns=sorted(columns), encoded=sorted(dictionaries),
+                    data_dir=data_dir and os.path.abspath(data_dir))
+    write_manifest(manifest, path)
+
+    for name in os.listdir(path):
+        if name not in (version, replaced, parsed_dir) and isdir(join(path, name)):
+            shutil.rmtree(join(path, name), ignore_errors=True)
+
+    return manifest
+
+
+def store_column(version_dir, name):
+    return np.load(join(version_dir, name + '.npy'), mmap_mode='r')
+
+
+def open_store(path=store_dir):
+    '''
+    Opens the store with every column memory-mapped read-only: only the pages of the rows a session slices are read,
+    and processes on one machine share a single copy of them through the OS page cache
+    Risk columns are left to the Dataset to open when first plotted
+    :param path: store directory
+    :return: the manifest and the Dataset, or None if there is no readable store of the current version
+    '''
+    try:
+        with open(join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != store_version:
+            return None
+
+        version_dir = join(path, manifest['directory'])
+        columns = {name: store_column(version_dir, name) for name in manifest['columns']
+                   if name not in lazy_columns}
+        dictionaries = {name: np.load(join(version_dir, name + '.values.npy')).astype(object)
+                        for name in manifest['encoded']}
+        statistics = np.load(join(version_dir, 'statistics.npy'))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return manifest, Dataset(columns, dictionaries, manifest['risk_list'], manifest, partial(store_column, version_dir),
+                             statistics)
+
+
+def build_store(data_dir=data_dir, path=store_dir, sources=None):
+    '''
+    Processes the source files and writes them to the store
+    :param data_dir: directory holding the source_files
+    :param path: store directory
+    :param sources: fingerprints of the source files if already known
+    :return: the manifest
+    '''
+    if sources is None:
+        sources = {name: file_fingerprint(join(data_dir, name)) for name in source_files}
+
+    df, risk_list = process_data(data_dir, join(path, parsed_dir), sources)
+    columns, dictionaries = partition_data(df)
+    return write_store(columns, dictionaries, risk_list, sources, path, data_dir)
+
+
+def load_dataset(data_dir=data_dir, path=store_dir):
+    '''
+    Opens the store when every source file still matches the fingerprint recorded in it,
+    otherwise rebuilds the store from the source files first
+    :param data_dir: directory holding the source_files
+    :param path: store directory
+    :return: Dataset
+    '''
+    with store_lock(path):
+        opened = open_store(path)
+        known = opened[0]['sources'] if opened else {}
+        sources = {name: file_fingerprint(join(data_dir, name), known.get(name)) for name in source_files}
+
+        if opened and sources != known:
+            if all((sources[name] or {}).get('sha1') == (known.get(name) or {}).get('sha1') for name in source_files):
+                # Only the timestamps moved, record them so the next start skips hashing
+                write_manifest(dict(opened[0], sources=sources, data_dir=os.path.abspath(data_dir)), path)
+            else:
+                built_from = opened[0].get('data_dir')
+                if built_from and built_from != os.path.abspath(data_dir):
+                    log.warning('Rebuilding the store in %s, built from %s, from %s, set PARKINSONS_DATA_DIR to '
+                                'serve the exports it was built from', path, built_from, data_dir)
+                opened = None
+
+        if opened is None:
+            build_store(data_dir, path, sources)
+            opened = open_store(path)
+
+    return opened[1]
+
+
+_dataset = None
+_dataset_lock = threading.Lock()
+
+
+def get_dataset():
+    '''
+    Returns the dataset shared by all sessions of this process, opening the store on first use
+    Called from server_lifecycle.on_server_loaded so this happens before the first session connects
+    :return: Dataset
+    '''
+    global _dataset
+    if _dataset is None:
+        with _dataset_lock:
+            if _dataset is None:
+                _dataset = load_dataset()
+    return _dataset
+
+
+_executor = None
+
+
+def frame_executor():
+    '''
+    Returns the thread pool shared by all sessions of this process for computing frames off the server's event loop
+    :return: concurrent.futures.ThreadPoolExecutor
+    '''
+    global _executor
+    if _executor is None:
+        with _dataset_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=frame_workers, thread_name_prefix='parkinsons-frame')
+    return _executor
+
+
+def set_dataset(dataset):
+    '''
+    Replaces the dataset shared by all sessions of this process, e.g. with one built from other source files
+    :param dataset: Dataset
+    '''
+    global _dataset
+    with _dataset_lock:
+        _dataset = dataset
+
+
+def value_rows(dataset, rows, column, value):
+    '''
+    Keeps the rows whose encoded column holds value, compared on the codes so nothing is decoded
+    :param dataset: Dataset
+    :param rows: array of row positions
+    :param column: encoded column
+    :param value: value to keep, or None to keep every row
+    :return: array of row positions
+    '''
+    if value is None:
+        return rows
+    values = list(dataset.dictionaries[column])
+    if value not in values:
+        return rows[:0]
+    return rows[dataset.columns[column][rows] == values.index(value)]
+
+
+def frame(year, risk=default_risk, sex=None, region=None, country=None, age=all_ages, level=country_level):
+    '''
+    One year of the dataset the app plots, opening the store on first use
+    :param year: year
+    :param risk: risk name from risk_map
+    :param sex: 'Male' or 'Female', or None for both
+    :param region: region from region.csv, or None for every region
+    :param country: location_name, or None for every location of the level
+    :param age: age group
+    :param level: location level, ignored when country is given
+    :return: Dataframe with a row per location and sex, the risk in its risk_map column
+    '''
+    dataset = get_dataset()
+    if country is None:
+        start, stop = dataset.frame_rows.get((age, level, year), (0, 0))
+        rows = np.arange(start, stop)
+    else:
+        rows, _ = dataset.country_rows([country], year, year, age)
+    rows = value_rows(dataset, value_rows(dataset, rows, 'sex_name', sex), 'regions', region)
+    return pd.DataFrame(dataset.rows(rows, risk_map[risk]))
+
+
+def series(country, risk=default_risk, sex=None, age=all_ages):
+    '''
+    Every year of one location, opening the store on first use
+    :param country: location_name
+    :param risk: risk name from risk_map
+    :param sex: 'Male' or 'Female', or None for both
+    :param age: age group
+    :return: Dataframe with a row per sex and year in year order, the risk in its risk_map column
+    '''
+    dataset = get_dataset()
+    rows, _ = dataset.country_rows([country], age=age)
+    rows = value_rows(dataset, rows, 'sex_name', sex)
+    return pd.DataFrame(dataset.rows(np.sort(rows), risk_map[risk]))
+
+
+class SourceWatcher(object):
+    '''
+    Polls the source files of a running server and swaps in a rebuilt dataset once any of them changed
+    The check and the rebuild run on a thread of their own, the event loop only starts them
+    '''
+
+    def __init__(self, data_dir=data_dir, path=store_dir):
+        '''
+        :param data_dir: directory holding the source_files
+        :param path: store directory
+        '''
+        self.data_dir = data_dir
+        self.path = path
+        self._seen = None
+        self._failed = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='parkinsons-reload')
+        self._running = None
+
+    def poll(self):
+        '''
+        Starts a check unless the last one is still running, called periodically from the server's event loop
+        '''
+        if self._running is None or self._running.done():
+            self._running = self._executor.submit(self.check)
+
+    def check(self):
+        '''
+        Compares the source files with those the shared dataset was built from and the store with the version it was
+        opened from. A changed file is only rebuilt from once its size and modification time held still for a whole
+        interval, so a file still being copied in is not read half-written
+        :return: the new Dataset, or None if it was not replaced
+        '''
+        current = get_dataset()
+        known = current.sources or {}
+        sources = {name: file_fingerprint(join(self.data_dir, name), known.get(name)) for name in source_files}
+        changed = [name for name in source_files
+                   if (sources[name] or {}).get('sha1') != (known.get(name) or {}).get('sha1')]
+
+        # Files touched without changing keep their new timestamps, so they are not hashed again on the next check
+        if not changed:
+            current.sources = sources
+            self._seen = None
+        else:
+            settled, self._seen = sources == self._seen, sources
+            if not settled or sources == self._failed:
+                return None
+
+        try:
+            with open(join(self.path, 'manifest.json')) as f:
+                directory = json.load(f).get('directory')
+        except (OSError, ValueError):
+            directory = None
+        if not changed and directory == current.directory:
+            return None
+
+        try:
+            dataset = load_dataset(self.data_dir, self.path)
+        except Exception:
+            # Tried again once the files change
+            log.exception('Rebuilding the dataset after %s changed failed, keeping the current one',
+                          ', '.join(changed) or 'the store')
+            self._failed = sources
+            return None
+        self._seen = None
+        if dataset.directory == current.directory:
+            return None
+
+        log.info('Swapped in dataset %s after %s changed', dataset.directory, ', '.join(changed) or 'the store')
+        set_dataset(dataset)
+        return dataset
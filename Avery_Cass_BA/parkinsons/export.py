@@ -0,0 +1,74 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Exports the app as a static site that any web server or CDN can host, with no `bokeh serve` behind it
+
+Usage:
+    python export.py
+    python export.py --out path/to/site
+
+The page is main.py run with --static: every year and risk is embedded in it, and the slider, play button,
+country and x-axis choices run in the browser. It is wrapped in templates/index.html like the served app and loads
+BokehJS from the Bokeh CDN. static/ is copied next to it for the images the template links to.
+
+"""
+
+import argparse
+import os
+import shutil
+from os.path import abspath, dirname, join
+
+from bokeh.application import Application
+from bokeh.application.handlers import DirectoryHandler
+from bokeh.document import Document
+from bokeh.embed import file_html
+from bokeh.resources import CDN
+
+app_dir = dirname(abspath(__file__))
+
+
+def build_document():
+    '''
+    Runs the app once in static mode
+    :return: bokeh Document with the template and theme of the app
+    '''
+    app = Application(DirectoryHandler(filename=app_dir, argv=['--static']))
+    doc = Document()
+    app.initialize_document(doc)
+    for handler in app.handlers:
+        if handler.failed:
+            raise RuntimeError(handler.error_detail)
+    return doc
+
+
+def export(out_dir):
+    '''
+    Writes index.html and the static files the template links to
+    :param out_dir: directory to write the site to
+    :return: path of the html file
+    '''
+    doc = build_document()
+    html = file_html(doc, CDN, title=doc.title, template=doc.template, theme=doc.theme)
+
+    # The template links to parkinsons/static/..., the path bokeh serve gives the app's static directory
+    os.makedirs(out_dir, exist_ok=True)
+    shutil.copytree(join(app_dir, 'static'), join(out_dir, 'parkinsons', 'static'), dirs_exist_ok=True)
+
+    path = join(out_dir, 'index.html')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=join(app_dir, 'export'), help='directory to write the site to')
+    args = parser.parse_args()
+
+    path = export(args.out)
+    print('Wrote %s (%.1f MB)' % (path, os.path.getsize(path) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,149 +10,162 @@ Email: averysoh@outlook.com
 
 import pandas as pd
 import numpy as np
+import logging
 import math
+import sys
+from functools import partial
 
-from data import process_data
+from data import get_dataset, frame_executor, risk_map, default_risk, all_ages, country_level, reload_interval
+from metrics import session_metrics
 from bokeh.core.properties import field
+from tornado import gen
+from bokeh.document import without_document_lock
 from bokeh.io import curdoc
 from bokeh.layouts import layout, column
-from bokeh.palettes import Blues8, PuRd6, RdPu9, PuBu9
+from bokeh.palettes import Blues8, PuRd6, RdPu9, PuBu9, RdBu11
 from bokeh.plotting import figure
 from bokeh.models import ColumnDataSource, HoverTool, BoxZoomTool, ResetTool, SingleIntervalTicker,\
-    Slider, Button, Label, CategoricalColorMapper, Legend, Circle, CheckboxButtonGroup, Select, NumeralTickFormatter
+    Slider, Button, Label, CategoricalColorMapper, Legend, Circle, CheckboxButtonGroup, Select, NumeralTickFormatter,\
+    CDSView, CustomJS, CustomJSFilter, GroupFilter, MultiSelect, LinearColorMapper, ColorBar, Span
 
 ###############
 # Import Data #
 ###############
-# Import the Dataset from process_data
-df, risk_list = process_data()
+# Import the Dataset shared by every session of this server process
+dataset = get_dataset()
+risk_list = dataset.risk_list
 
 # Widgets to add, country list select, region select, x axis select, male female select
 
-# Setting the size factor of each point
-scale_factor = 1100
-parkinsons_size = 10 * (scale_factor * (df["prevalence"]))
-df.loc[:, "parkinsons_size"] = parkinsons_size
+# Create the necessary years, region, country, risk names list
+years = dataset.years
+regions_list = dataset.regions
 
+country_list = dataset.countries
 
-# Create the necessary years, region, country, risk names list
-years = list(range(1990, 2018, 1))
-regions_list = list(df.regions.unique())
-
-a = df.location_name.unique()
-country_list = ['None Selected']
-country_list.extend(sorted(a))
-
-risk_map = {
-    'Diet high in processed meat': 'processed_meat',
-    'Diet high in sodium': 'sodium',
-    'Diet high in sugar-sweetened beverages': 'sugar',
-    'Diet low in fruits': 'fruits',
-    'Diet low in legumes': 'legumes',
-    'Diet low in milk': 'milk',
-    'Diet low in vegetables': 'veg',
-    'Diet low in whole grains': 'grains',
-    'High LDL cholesterol': 'cholesterol',
-    'High body-mass index': 'bmi',
-    'High fasting plasma glucose': 'glucose',
-    'Smoking': 'smoking',
-}
-
-# Extract from the dataset the male and female categories followed by the necessary relevant data
-df_both = df.copy()
+
+def session_argument(name, default):
+    '''
+    Reads a query argument from the URL the session was opened with, e.g. ?playback=client
+    :param name: argument name
+    :param default: value used when the argument is missing or there is no request
+    :return: the argument value as a string
+    '''
+    context = curdoc().session_context
+    if context is None or context.request is None:
+        return default
+    values = context.request.arguments.get(name)
+    return values[0].decode() if values else default
+
+
+# With ?playback=client every year is sent to the browser once and year changes and playback run there
+# Otherwise the server sends the selected year on every slider change
+# With --static, passed by export.py, every risk is sent as well and the country and x-axis choices also run in the
+# browser, so the page needs no server at all
+static = '--static' in sys.argv[1:]
+client_side = static or session_argument('playback', 'server') == 'client'
+
+# With ?playback=smooth the server still sends one frame a year, but lined up on the same slots every year so the
+# browser can tween the points from one year to the next at ?fps frames a second, at no extra cost to the server
+smooth = not client_side and session_argument('playback', 'server') == 'smooth'
+tween_fps = 30
+if smooth:
+    # A bad ?fps keeps the default, and the rate is kept between 1 and 60 frames a second, the most browsers draw
+    try:
+        fps = float(session_argument('fps', tween_fps))
+    except ValueError:
+        fps = math.nan
+    if not math.isnan(fps):
+        tween_fps = min(max(fps, 1), 60)
+
+# Milliseconds each year is shown for when playing
+year_ms = 500
+
+# Callback timings for this session, only recorded when PARKINSONS_METRICS is set
+metrics = session_metrics(curdoc())
+
+# Kept for the callbacks that run without the document lock
+doc = curdoc()
+
+log = logging.getLogger('parkinsons.main')
 
 ############################
 # Functions to filter Data #
 ############################
 
 
-# Create a function to filter dataset by year
-def country_data(year, country):
+def source_data(data, x_column):
     '''
-    Creates two dataframes based on a selected period and country
-    For specific use in country selection from dropdown to plot course of single country
-    :param year: year from years
-    :param country: country from country_list
-    :return: 2 Dataframes, 1 for men and 1 for women
+    Picks the columns used by the glyphs and hover tool from a slice of the dataset
+    :param data: dict of column arrays from the dataset
+    :param x_column: dataset column plotted on the x-axis, from risk_map
+    :return: dict for ColumnDataSource.data
     '''
-    df_men = df_both.loc[df_both["sex_name"] == "Male"]
-    data_men = df_men.loc[df_men['year'] == year]
-    data_men = data_men.loc[data_men['location_name'] == country]
-
-    df_women = df_both.loc[df_both["sex_name"] == "Female"]
-    data_women = df_women.loc[df_women['year'] == year]
-    data_women = data_women.loc[data_women['location_name'] == country]
-
-    return data_men, data_women
+    return dict(
+        x=data[x_column],
+        y=data['incidence'],
+        location_name=data['location_name'],
+        regions=data['regions'],
+        parkinsons_size=data['parkinsons_size'],
+        prevalence=data['prevalence'],
+        sex_name=data['sex_name'],
+        year=data['year']
+    )
 
 
-def region_data(year, region):
+def interval_data(data, x_column):
     '''
-    Creates two dataframes based on a selected period and region
-    :param year: year from years
-    :param region: region from region_list
-    :return: 2 Dataframes, 1 for men and 1 for women
+    Picks the columns of the uncertainty overlay from a slice of the dataset taken with its interval columns
+    :param data: dict of column arrays from the dataset
+    :param x_column: dataset column plotted on the x-axis, from risk_map
+    :return: dict for interval_src.data
     '''
-    df_men = df_both.loc[df_both["sex_name"] == "Male"]
-    data_men = df_men.loc[df_men['year'] == year]
-    data_men = data_men.loc[data_men['regions'] == region]
+    return dict(
+        x=data[x_column],
+        y=data['incidence'],
+        lower=data['incidence_lower'],
+        upper=data['incidence_upper'],
+        location_name=data['location_name'],
+        sex_name=data['sex_name'],
+        year=data['year']
+    )
 
-    df_women = df_both.loc[df_both["sex_name"] == "Female"]
-    data_women = df_women.loc[df_women['year'] == year]
-    data_women = data_women.loc[data_women['regions'] == region]
 
-    return data_men, data_women
+# Establishing the data source
+# One source holds every region and sex of the current frame, the renderers pick their group through views
+frame_src = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
+                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]), name='frame')
 
+country_src = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
+                                         parkinsons_size=[], prevalence=[], sex_name=[], year=[]), name='country')
 
-# Establishing the data source
-m_america = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-w_america = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-m_eu_asia = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-w_eu_asia = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-m_sub_africa = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                          parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-w_sub_africa = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                          parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-m_mid_africa = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                          parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-w_mid_africa = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                          parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-m_pacific = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-w_pacific = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-m_sea = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                   parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-w_sea = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                   parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-
-country_men_src = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                             parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
-country_women_src = ColumnDataSource(data=dict(x=[], y=[], location_name=[], regions=[],
-                                               parkinsons_size=[], prevalence=[], sex_name=[], year=[]))
+# 95% uncertainty interval of incidence of every point, left empty unless the overlay is turned on
+no_interval = dict(x=[], y=[], lower=[], upper=[], location_name=[], sex_name=[], year=[])
+interval_src = ColumnDataSource(data=no_interval, name='interval')
+
+# Path of each selected country from the first year to the current one, x0 and y0 being the year before
+# Playing forward streams one year of points onto it, anything else replaces it
+trail_src = ColumnDataSource(data=dict(x=[], y=[], x0=[], y0=[], location_name=[], regions=[],
+                                       parkinsons_size=[], prevalence=[], sex_name=[], year=[]), name='trail')
 
 ########
 # Plot #
 ########
 # Set the plot environment, x-axis = sugar, y-axis = Incidence of parkinsons
-plot = figure(y_range=(0, max(df_both["incidence"]) * 1.1),
+plot = figure(y_range=dataset.y_range,
               title="Parkinson's Disease Prevalence",
               x_axis_type="log",
               tools="pan,tap,lasso_select,wheel_zoom,reset,save",
               toolbar_location="above",
               plot_height=450, plot_width=700,
-              x_range=(0.15*(10**min(df['sugar']) - 1), 0.3*(10**max(df['sugar']) + 0.1))
+              x_range=dataset.x_ranges[risk_map[default_risk]]
               )
 # To log and fix the x axis
 #             x_range=(10 ** -5.5, 10 ** 0),
 #             x_axis_type="log",
 
 plot.title.text_font_size = "16px"
-plot.xaxis.axis_label = "Diet high in sugar-sweetened beverages"
+plot.xaxis.axis_label = default_risk
 plot.yaxis.axis_label = "Incidence of Parkinson's Disease (percentage %)"
 plot.yaxis.formatter = NumeralTickFormatter(format='0.000%')
 bg_colour = '#fff9ed'
@@ -167,64 +180,45 @@ plot.add_layout(label)
 alpha_plot = 0.4
 alpha = 0.75
 
-# Plot points
-# Plot Male Regions
-Europe = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=m_eu_asia, fill_color="#084594", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-Middle = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=m_mid_africa, fill_color="#2171b5", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-East = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=m_pacific, fill_color="#4292c6", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-Sub = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=m_sub_africa, fill_color="#6baed6", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-America = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=m_america, fill_color="#9ecae1", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-South = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=m_sea, fill_color="#c6dbef", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-
-# Plot Female Region
-Europe_f = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=w_eu_asia, fill_color="#980043", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-Middle_f = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=w_mid_africa, fill_color="#dd1c77", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-East_f = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=w_pacific, fill_color="#df65b0", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-Sub_f = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=w_sub_africa, fill_color="#c994c7", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-America_f = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=w_america, fill_color="#d4b9da", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-South_f = plot.circle(x='x', y='y', size='parkinsons_size',
-                     source=w_sea, fill_color="#f1eef6", line_color='#7c7e71',
-                     line_width=0.5, line_alpha=0.5, fill_alpha=alpha_plot)
-
-# Plot selected country
-country_m = plot.circle(
-            x='x',
-            y='y',
-            size='parkinsons_size',
-            source=country_men_src,
-            fill_alpha=0.9,
-            fill_color="#084594",
-            line_color=None
-        )
-country_w = plot.circle(
+# Plot points, one renderer per region and sex so the legend can toggle each of them
+legend_regions = ['Europe & Central Asia', 'Middle East & North Africa', 'East Asia & Pacific',
+                  'Sub-Saharan Africa', 'America', 'South Asia']
+
+# Shades of blue for men and pink for women, one shade per region
+men_colors = CategoricalColorMapper(factors=legend_regions,
+                                    palette=['#084594', '#2171b5', '#4292c6', '#6baed6', '#9ecae1', '#c6dbef'])
+women_colors = CategoricalColorMapper(factors=legend_regions,
+                                      palette=['#980043', '#dd1c77', '#df65b0', '#c994c7', '#d4b9da', '#f1eef6'])
+
+region_renderers = {}
+for sex, colors in [('Male', men_colors), ('Female', women_colors)]:
+    for region in legend_regions:
+        view = CDSView(source=frame_src, filters=[GroupFilter(column_name='regions', group=region),
+                                                  GroupFilter(column_name='sex_name', group=sex)])
+        region_renderers[sex, region] = plot.circle(x='x', y='y', size='parkinsons_size',
+                                                    source=frame_src, view=view,
+                                                    fill_color=dict(field='regions', transform=colors),
+                                                    line_color='#7c7e71', line_width=0.5, line_alpha=0.5,
+                                                    fill_alpha=alpha_plot)
+
+sex_colors = CategoricalColorMapper(factors=['Male', 'Female'], palette=['#084594', '#980043'])
+
+# Plot the trails of the selected countries
+trail_renderers = [
+    plot.segment(x0='x0', y0='y0', x1='x', y1='y', source=trail_src,
+                 line_color=dict(field='sex_name', transform=sex_colors), line_alpha=0.5, line_width=1.5),
+    plot.circle(x='x', y='y', size=4, source=trail_src,
+                fill_color=dict(field='sex_name', transform=sex_colors), fill_alpha=0.5, line_color=None),
+]
+
+# Plot selected countries
+country_renderer = plot.circle(
             x='x',
             y='y',
             size='parkinsons_size',
-            source=country_women_src,
+            source=country_src,
             fill_alpha=0.9,
-            fill_color="#980043",
+            fill_color=dict(field='sex_name', transform=sex_colors),
             line_color=None
         )
 
@@ -237,24 +231,25 @@ TOOLTIPS = [
     ("(x,y)", "($x, $y)"),
 ]
 
-plot.add_tools(HoverTool(tooltips=TOOLTIPS, show_arrow=False, point_policy='follow_mouse'))
+plot.add_tools(HoverTool(renderers=list(plot.renderers), tooltips=TOOLTIPS, show_arrow=False,
+                         point_policy='follow_mouse'))
+
+# Uncertainty whiskers, with their own tooltip
+interval_renderer = plot.segment(x0='x', y0='lower', x1='x', y1='upper', source=interval_src,
+                                 line_color=dict(field='sex_name', transform=sex_colors), line_alpha=0.6,
+                                 line_width=1.5)
+plot.add_tools(HoverTool(renderers=[interval_renderer], show_arrow=False, point_policy='follow_mouse', tooltips=[
+    ('Country', "@location_name"),
+    ('Gender', '@sex_name'),
+    ('Incidence', "@y{(0.0000 %)}"),
+    ('95% UI', "@lower{(0.0000 %)} to @upper{(0.0000 %)}"),
+]))
 
 
 # Legend configuration
 legend = Legend(
-    items=[("Europe & Central Asia", [Europe]),
-           ("Middle East & North Africa", [Middle]),
-           ("East Asia & Pacific", [East]),
-           ("Sub-Saharan Africa", [Sub]),
-           ("America", [America]),
-           ("South Asia", [South]),
-           ("Europe & Central Asia", [Europe_f]),
-           ("Middle East & North Africa", [Middle_f]),
-           ("East Asia & Pacific", [East_f]),
-           ("Sub-Saharan Africa", [Sub_f]),
-           ("America", [America_f]),
-           ("South Asia", [South_f])
-           ],
+    items=[(region, [region_renderers['Male', region]]) for region in legend_regions] +
+          [(region, [region_renderers['Female', region]]) for region in legend_regions],
     location="top_center", orientation="vertical",
 )
 
@@ -263,202 +258,223 @@ plot.legend.background_fill_alpha = 0.0
 plot.legend.click_policy = "hide"
 
 
+# Widget changes only ask for a frame, which is drawn on the next tick from whatever the widgets hold by then
+# One frame is computed or sent at a time, changes made meanwhile are drawn once it is done, so fast slider drags
+# collapse into a few frames of the latest values
+frame_pending = False
+frame_stale = False
+
+
+def request_frame():
+    global frame_pending, frame_stale
+    if doc.session_context is None:
+        # No server to run the tick, e.g. benchmark.py driving a bare Document
+        update()
+    elif frame_pending:
+        frame_stale = True
+    else:
+        frame_pending = True
+        doc.add_next_tick_callback(render_frame)
+
+
+@gen.coroutine
+@without_document_lock
+def render_frame():
+    # The frame is sliced on the shared executor, so sessions of this process do not wait on each other's slicing,
+    # and only the swap of the source data takes the document lock
+    global frame_stale
+    finishing = False
+    try:
+        frame_stale = False
+        state = frame_state()
+        computed = yield frame_executor().submit(compute_frame, state, trail_shown)
+        doc.add_next_tick_callback(metrics.timed('frame', partial(finish_frame, state, computed)))
+        finishing = True
+    except Exception:
+        log.exception('Computing a frame failed')
+    finally:
+        # A failed frame must not leave the session pending, or no later change would ever be drawn
+        if not finishing:
+            frame_done()
+
+
+def finish_frame(state, computed):
+    try:
+        show_frame(state, computed)
+    except Exception:
+        log.exception('Showing the frame of %s failed', state[0])
+    finally:
+        frame_done()
+
+
+def frame_done():
+    # Lets the next frame be requested and draws the changes made while this one was on its way
+    global frame_pending
+    frame_pending = False
+    if frame_stale:
+        request_frame()
+
+
 # Creating the animation function
-def animate_update():
+def next_year():
     year = year_slider.value + 1
     if year > years[-1]:
         year = years[0]
     year_slider.value = year
 
 
-# Updating the animation function
-def update():
-    year = year_slider.value
-    country = country_choice.value
-    label.text = str(year)
+@without_document_lock
+def animate_update():
+    # Runs outside the document lock, so it still runs while the previous frame is being sent to a slow browser
+    # Playback then drops the frame instead of queueing it
+    global frame_pending
+    if frame_pending:
+        metrics.skipped()
+    elif doc.session_context is None:
+        next_year()
+    else:
+        frame_pending = True
+        doc.add_next_tick_callback(advance_frame)
+
 
+def advance_frame():
+    next_year()
+    doc.add_next_tick_callback(render_frame)
+
+
+# Updating the axes, only needed when a different risk or age group is chosen
+def update_axis():
     x_name_ = risk_map[x_name.value]
     plot.xaxis.axis_label = x_name.value
-    plot.x_range.start = 0.15*(10**min(df[x_name_]) - 1)
-    plot.x_range.end = 0.3*(10**max(df[x_name_]) + 0.1)
-
-    m_a, w_a = region_data(year, 'America')
-    m_america.data = dict(
-        x=m_a[x_name_],
-        y=m_a['incidence'],
-        location_name=m_a['location_name'],
-        regions=m_a['regions'],
-        parkinsons_size=m_a['parkinsons_size'],
-        prevalence=m_a['prevalence'],
-        sex_name=m_a['sex_name'],
-        year=m_a['year']
-    )
-    w_america.data = dict(
-        x=w_a[x_name_],
-        y=w_a['incidence'],
-        location_name=w_a['location_name'],
-        regions=w_a['regions'],
-        parkinsons_size=w_a['parkinsons_size'],
-        prevalence=w_a['prevalence'],
-        sex_name=w_a['sex_name'],
-        year=w_a['year']
-    )
+    plot.x_range.start, plot.x_range.end = dataset.x_ranges[x_name_]
+    plot.y_range.start, plot.y_range.end = dataset.y_ranges[age_choice.value]
 
-    m_a, w_a = region_data(year, 'Europe & Central Asia')
-    m_eu_asia.data = dict(
-        x=m_a[x_name_],
-        y=m_a['incidence'],
-        location_name=m_a['location_name'],
-        regions=m_a['regions'],
-        parkinsons_size=m_a['parkinsons_size'],
-        prevalence=m_a['prevalence'],
-        sex_name=m_a['sex_name'],
-        year=m_a['year']
-    )
-    w_eu_asia.data = dict(
-        x=w_a[x_name_],
-        y=w_a['incidence'],
-        location_name=w_a['location_name'],
-        regions=w_a['regions'],
-        parkinsons_size=w_a['parkinsons_size'],
-        prevalence=w_a['prevalence'],
-        sex_name=w_a['sex_name'],
-        year=w_a['year']
-    )
 
-    m_a, w_a = region_data(year, 'Sub-Saharan Africa')
-    m_sub_africa.data = dict(
-        x=m_a[x_name_],
-        y=m_a['incidence'],
-        location_name=m_a['location_name'],
-        regions=m_a['regions'],
-        parkinsons_size=m_a['parkinsons_size'],
-        prevalence=m_a['prevalence'],
-        sex_name=m_a['sex_name'],
-        year=m_a['year']
-    )
-    w_sub_africa.data = dict(
-        x=w_a[x_name_],
-        y=w_a['incidence'],
-        location_name=w_a['location_name'],
-        regions=w_a['regions'],
-        parkinsons_size=w_a['parkinsons_size'],
-        prevalence=w_a['prevalence'],
-        sex_name=w_a['sex_name'],
-        year=w_a['year']
-    )
+def change_axis():
+    update_axis()
+    request_frame()
 
-    m_a, w_a = region_data(year, 'Middle East & North Africa')
-    m_mid_africa.data = dict(
-        x=m_a[x_name_],
-        y=m_a['incidence'],
-        location_name=m_a['location_name'],
-        regions=m_a['regions'],
-        parkinsons_size=m_a['parkinsons_size'],
-        prevalence=m_a['prevalence'],
-        sex_name=m_a['sex_name'],
-        year=m_a['year']
-    )
-    w_mid_africa.data = dict(
-        x=w_a[x_name_],
-        y=w_a['incidence'],
-        location_name=w_a['location_name'],
-        regions=w_a['regions'],
-        parkinsons_size=w_a['parkinsons_size'],
-        prevalence=w_a['prevalence'],
-        sex_name=w_a['sex_name'],
-        year=w_a['year']
-    )
 
-    m_a, w_a = region_data(year, 'East Asia & Pacific')
-    m_pacific.data = dict(
-        x=m_a[x_name_],
-        y=m_a['incidence'],
-        location_name=m_a['location_name'],
-        regions=m_a['regions'],
-        parkinsons_size=m_a['parkinsons_size'],
-        prevalence=m_a['prevalence'],
-        sex_name=m_a['sex_name'],
-        year=m_a['year']
-    )
-    w_pacific.data = dict(
-        x=w_a[x_name_],
-        y=w_a['incidence'],
-        location_name=w_a['location_name'],
-        regions=w_a['regions'],
-        parkinsons_size=w_a['parkinsons_size'],
-        prevalence=w_a['prevalence'],
-        sex_name=w_a['sex_name'],
-        year=w_a['year']
-    )
+def frame_state():
+    return (year_slider.value, tuple(country_choice.value), risk_map[x_name.value], age_choice.value,
+            level_choice.value, bool(overlay.active), dataset)
 
-    m_a, w_a = region_data(year, 'South Asia')
-    m_sea.data = dict(
-        x=m_a[x_name_],
-        y=m_a['incidence'],
-        location_name=m_a['location_name'],
-        regions=m_a['regions'],
-        parkinsons_size=m_a['parkinsons_size'],
-        prevalence=m_a['prevalence'],
-        sex_name=m_a['sex_name'],
-        year=m_a['year']
-    )
-    w_sea.data = dict(
-        x=w_a[x_name_],
-        y=w_a['incidence'],
-        location_name=w_a['location_name'],
-        regions=w_a['regions'],
-        parkinsons_size=w_a['parkinsons_size'],
-        prevalence=w_a['prevalence'],
-        sex_name=w_a['sex_name'],
-        year=w_a['year']
-    )
 
-    plot.title.text = "Parkinson's Disease Prevalence in %s" % year
+# Year, countries and risk the trails were last drawn for
+trail_shown = None
 
-    if country != 'None Selected':
-        country_men, country_women = country_data(year, country)
-        country_men_src.data = dict(
-            x=country_men[x_name_],
-            y=country_men['incidence'],
-            location_name=country_men['location_name'],
-            regions=country_men['regions'],
-            parkinsons_size=country_men['parkinsons_size'],
-            prevalence=country_men['prevalence'],
-            sex_name=country_men['sex_name'],
-            year=country_men['year']
-        )
 
-        country_women_src.data = dict(
-            x=country_women[x_name_],
-            y=country_women['incidence'],
-            location_name=country_women['location_name'],
-            regions=country_women['regions'],
-            parkinsons_size=country_women['parkinsons_size'],
-            prevalence=country_women['prevalence'],
-            sex_name=country_women['sex_name'],
-            year=country_women['year']
-        )
+def trail_data(current, countries, x_column, first_year, last_year, age=all_ages):
+    '''
+    :param current: Dataset to slice
+    :param countries: location_names of the selected countries
+    :param x_column: dataset column plotted on the x-axis
+    :param first_year: first year of the trail, or None for the first year of the data
+    :param last_year: last year of the trail, or None for the last year of the data
+    :param age: age group
+    :return: dict for trail_src.data, or to stream onto it
+    '''
+    rows, previous = current.country_rows(countries, first_year, last_year, age)
+    data = source_data(current.rows(rows, x_column), x_column)
+    data['x0'] = current.risk_column(x_column)[previous]
+    data['y0'] = current.columns['incidence'][previous]
+    return data
 
-    else:
-        country_men_src.data = dict(
-            x=[], y=[], location_name=[], regions=[],
-            parkinsons_size=[], prevalence=[], sex_name=[], year=[])
 
-        country_women_src.data = dict(
-            x=[], y=[], location_name=[], regions=[],
-            parkinsons_size=[], prevalence=[], sex_name=[], year=[])
+def compute_frame(state, trail_from):
+    '''
+    Slices the data of one frame, only reads the dataset in state so it is safe to run on any thread
+    :param state: (year, countries, x column, age group, location level, overlay on, Dataset) from frame_state
+    :param trail_from: state the trails were last drawn for
+    :return: the data of frame_src, of country_src and of trail_src, whether the trail data is streamed onto
+             trail_src instead of replacing its data, and the data of interval_src or None with the overlay off
+    '''
+    year, countries, x_name_, age, level, intervals, current = state
+
+    # Client side playback sends every year and lets the views in the browser pick the current one
+    frame_year = None if client_side else year
+
+    # Each part is prepared once per process and reused by every session asking for the same one
+    # Sessions get their own dicts, the arrays are shared and never written to
+    cache = current.frame_cache
+    with metrics.stage('slice'):
+        if smooth:
+            frame = cache.get(('aligned', frame_year, x_name_, age, level), lambda key: sliced(
+                source_data(current.aligned_data(frame_year, x_name_, age, level), x_name_)))
+        else:
+            frame = cache.get(('frame', frame_year, x_name_, age, level), lambda key: sliced(
+                source_data(current.year_data(frame_year, x_name_, age, level), x_name_)))
+        country_frame = cache.get(('country', frame_year, countries, x_name_, age), lambda key: sliced(
+            source_data(current.rows(current.country_rows(countries, frame_year, frame_year, age)[0], x_name_),
+                        x_name_)))
+
+        # The year after the one drawn only adds its own points to the trails
+        stream = not client_side and trail_from == (year - 1,) + state[1:]
+        first_year = year if stream else None
+        trail = cache.get(('trail', first_year, frame_year, countries, x_name_, age), lambda key: sliced(
+            trail_data(current, countries, x_name_, first_year, frame_year, age)))
+
+        # Interval columns are only read while the overlay is on
+        interval = None
+        if intervals:
+            interval = dict(cache.get(('interval', frame_year, x_name_, age, level), lambda key: sliced(
+                interval_data(current.year_data(frame_year, x_name_, age, level, intervals=True), x_name_))))
+
+    return dict(frame), dict(country_frame), dict(trail), stream, interval
+
+
+def sliced(data):
+    '''
+    Counts the rows of a frame part that had to be sliced rather than found in the frame cache
+    :param data: dict of column arrays
+    :return: data
+    '''
+    metrics.touched(len(data['year']))
+    return data
+
+
+def show_frame(state, computed):
+    global trail_shown
+    year = state[0]
+    frame_data, country_data, trail, stream, interval = computed
+
+    label.text = str(year)
+    with metrics.stage('assign'):
+        frame_src.data = frame_data
+        country_src.data = country_data
+        if stream:
+            trail_src.stream(trail)
+        else:
+            trail_src.data = trail
+        if interval is not None:
+            interval_src.data = interval
+        elif len(interval_src.data['x']):
+            interval_src.data = no_interval
+    trail_shown = state
+    plot.title.text = "Parkinson's Disease Prevalence in %s" % year
+
+
+# Updating the animation function
+def update():
+    state = frame_state()
+    show_frame(state, compute_frame(state, trail_shown))
 
 
 # Set the starting point of the animation
 year_slider = Slider(start=years[0], end=years[-1], value=years[0], step=1, title="Year")
-year_slider.on_change('value', lambda attr, old, new: update())
 
-country_choice = Select(title='Country Choice', value='All', options=country_list)
-country_choice.on_change('value', lambda attr, old, new: update())
-
-x_name = Select(title='X-axis Choice', value='Diet high in sugar-sweetened beverages', options=risk_list)
-x_name.on_change('value', lambda attr, old, new: update())
+country_choice = MultiSelect(title='Country Choice', value=[], options=country_list, size=6)
+x_name = Select(title='X-axis Choice', value=default_risk, options=risk_list)
+age_choice = Select(title='Age Group', value=all_ages if all_ages in dataset.ages else dataset.ages[0],
+                    options=dataset.ages)
+level_choice = Select(title='Location Level', value=country_level, options=dataset.levels)
+overlay = CheckboxButtonGroup(labels=['Uncertainty'], active=[])
+if not static:
+    country_choice.on_change('value', metrics.timed('country_choice', lambda attr, old, new: request_frame()))
+    x_name.on_change('value', metrics.timed('x_name', lambda attr, old, new: change_axis()))
+    age_choice.on_change('value', metrics.timed('age_choice', lambda attr, old, new: change_axis()))
+    level_choice.on_change('value', metrics.timed('level_choice', lambda attr, old, new: request_frame()))
+    overlay.on_change('active', metrics.timed('overlay', lambda attr, old, new: request_frame()))
 
 
 callback_id = None
@@ -469,22 +485,267 @@ def animate():
     global callback_id
     if button.label == '► Play':
         button.label = '❚❚ Pause'
-        callback_id = curdoc().add_periodic_callback(animate_update, 500)
+        callback_id = doc.add_periodic_callback(metrics.timed('animate_update', animate_update), year_ms)
     else:
         button.label = '► Play'
-        curdoc().remove_periodic_callback(callback_id)
+        doc.remove_periodic_callback(callback_id)
 
 
 button = Button(label='► Play', width=60)
-button.on_click(animate)
+
+if client_side:
+    # Show only the rows of the selected year, recomputed in the browser whenever the sources change
+    year_filter = CustomJSFilter(args=dict(slider=year_slider), code='''
+        const year = slider.value;
+        const years = source.data['year'];
+        const indices = [];
+        for (let i = 0; i < years.length; i++) {
+            if (years[i] == year) {
+                indices.push(i);
+            }
+        }
+        return indices;
+    ''')
+    for renderer in region_renderers.values():
+        renderer.view.filters = list(renderer.view.filters) + [year_filter]
+    country_renderer.view = CDSView(source=country_src, filters=[year_filter])
+
+    # Trails hold every year and show those up to the selected one
+    trail_filter = CustomJSFilter(args=dict(slider=year_slider), code='''
+        const year = slider.value;
+        const years = source.data['year'];
+        const indices = [];
+        for (let i = 0; i < years.length; i++) {
+            if (years[i] <= year) {
+                indices.push(i);
+            }
+        }
+        return indices;
+    ''')
+    for renderer in trail_renderers:
+        renderer.view = CDSView(source=trail_src, filters=[trail_filter])
+
+    interval_renderer.view = CDSView(source=interval_src, filters=[year_filter])
+
+    sources = [frame_src, country_src, trail_src, interval_src]
+    year_slider.js_on_change('value', CustomJS(args=dict(sources=sources, label=label, title=plot.title), code='''
+        const year = cb_obj.value;
+        label.text = String(year);
+        title.text = "Parkinson's Disease Prevalence in " + year;
+        for (const source of sources) {
+            source.change.emit();
+        }
+    '''))
+    button.js_on_click(CustomJS(args=dict(slider=year_slider, year_ms=year_ms), code='''
+        if (cb_obj.label == '► Play') {
+            cb_obj.label = '❚❚ Pause';
+            cb_obj._timer = setInterval(function () {
+                slider.value = slider.value + 1 > slider.end ? slider.start : slider.value + 1;
+            }, year_ms);
+        } else {
+            cb_obj.label = '► Play';
+            clearInterval(cb_obj._timer);
+        }
+    '''))
+else:
+    year_slider.on_change('value', metrics.timed('year_slider', lambda attr, old, new: request_frame()))
+    button.on_click(animate)
+
+if smooth:
+    # Each new frame moves the points from where they are shown to their new place over one year_ms, redrawn from
+    # the two sets of positions in the browser. Frames of another length, e.g. a new country choice, are shown as sent
+    tween = CustomJS(args=dict(duration=year_ms, fps=tween_fps), code='''
+        const source = cb_obj;
+        const columns = ['x', 'y', 'parkinsons_size'];
+        const tween = source._tween || (source._tween = {});
+        clearInterval(tween.timer);
+
+        const from = tween.shown;
+        const to = {};
+        for (const column of columns) {
+            to[column] = Float64Array.from(source.data[column]);
+        }
+        tween.shown = to;
+        if (from === undefined || from.x.length != to.x.length) {
+            return;
+        }
+
+        const shown = {};
+        for (const column of columns) {
+            shown[column] = Float64Array.from(from[column]);
+        }
+        tween.shown = shown;
+        const start = Date.now();
+        function step() {
+            const t = Math.min((Date.now() - start) / duration, 1);
+            for (const column of columns) {
+                const values = source.data[column];
+                const a = from[column], b = to[column], now = shown[column];
+                for (let i = 0; i < values.length; i++) {
+                    now[i] = isNaN(a[i]) ? b[i] : a[i] + (b[i] - a[i]) * t;
+                    values[i] = now[i];
+                }
+            }
+            source.change.emit();
+            if (t >= 1) {
+                clearInterval(tween.timer);
+            }
+        }
+        step();
+        tween.timer = setInterval(step, 1000 / fps);
+    ''')
+    frame_src.js_on_change('data', tween)
+    country_src.js_on_change('data', tween)
+
+if static:
+    # The selected countries and their trails are drawn from the same source as every other point,
+    # picked by a second filter
+    country_filter = CustomJSFilter(args=dict(select=country_choice), code='''
+        const countries = select.value;
+        const names = source.data['location_name'];
+        const indices = [];
+        for (let i = 0; i < names.length; i++) {
+            if (countries.indexOf(names[i]) >= 0) {
+                indices.push(i);
+            }
+        }
+        return indices;
+    ''')
+    country_renderer.data_source = frame_src
+    country_renderer.view = CDSView(source=frame_src, filters=[year_filter, country_filter])
+    for renderer in trail_renderers:
+        renderer.data_source = frame_src
+        renderer.view = CDSView(source=frame_src, filters=[trail_filter, country_filter])
+    country_choice.js_on_change('value', CustomJS(args=dict(source=frame_src), code='''
+        source.change.emit();
+    '''))
+
+    # Every risk column is in the source, choosing a risk copies it into x and moves the axis to its extent
+    # The trails take x0 from the row of the year before, whose position is kept in previous
+    x_name.js_on_change('value', CustomJS(args=dict(source=frame_src, x_range=plot.x_range, axis=plot.xaxis[0],
+                                                    columns=risk_map, ranges=dataset.x_ranges), code='''
+        const column = columns[cb_obj.value];
+        axis.axis_label = cb_obj.value;
+        x_range.start = ranges[column][0];
+        x_range.end = ranges[column][1];
+        const x = source.data[column];
+        const previous = source.data['previous'];
+        const x0 = new Float64Array(x.length);
+        for (let i = 0; i < x.length; i++) {
+            x0[i] = x[previous[i]];
+        }
+        source.data['x'] = x;
+        source.data['x0'] = x0;
+        source.change.emit();
+    '''))
+
+###########
+# Heatmap #
+###########
+# Correlation across locations of every risk with the chosen measure by year, one heatmap per sex
+# The statistics are worked out with the dataset, a session only picks the block of its age group and level
+statistics_measure = Select(title='Heatmap Measure', value='Incidence', options=['Incidence', 'Prevalence'])
+statistics_src = ColumnDataSource(data=dict(risk=[], year=[], sex_name=[], correlation=[], slope=[]),
+                                  name='statistics')
+
+
+def show_statistics():
+    data = dict(dataset.statistics_data(age_choice.value, level_choice.value))
+    measure = statistics_measure.value.lower()
+    data.update(correlation=data['correlation_' + measure], slope=data['slope_' + measure])
+    statistics_src.data = data
+
+
+correlation_colors = LinearColorMapper(palette=RdBu11[::-1], low=-1, high=1, nan_color='#e0e0e0')
+year_span = Span(location=year_slider.value, dimension='height', line_color='#8a8a8a', line_width=2)
+year_slider.js_link('value', year_span, 'location')
+
+heatmaps = []
+for sex in ['Female', 'Male']:
+    heatmap = figure(title='Correlation with %s, %s' % (statistics_measure.value.lower(), sex),
+                     y_range=sorted(risk_map, reverse=True), x_range=(years[0] - 0.5, years[-1] + 0.5),
+                     tools='hover,save', toolbar_location=None, plot_height=350, plot_width=350,
+                     tooltips=[('Risk', '@risk'), ('Year', '@year'), ('Correlation', '@correlation{0.00}'),
+                               ('Slope', '@slope{0.000e}')])
+    heatmap.rect(x='year', y='risk', width=1, height=1, source=statistics_src,
+                 view=CDSView(source=statistics_src, filters=[GroupFilter(column_name='sex_name', group=sex)]),
+                 fill_color=dict(field='correlation', transform=correlation_colors), line_color=None)
+    heatmap.add_layout(year_span)
+    heatmap.grid.visible = False
+    heatmap.background_fill_color = bg_colour
+    heatmap.border_fill_color = bg_colour
+    heatmaps.append(heatmap)
+heatmaps[-1].yaxis.visible = False
+heatmaps[-1].add_layout(ColorBar(color_mapper=correlation_colors, width=10, background_fill_color=bg_colour), 'right')
+
+# The measure is switched in the browser, every session and the static page hold the columns of both
+statistics_measure.js_on_change('value', CustomJS(args=dict(source=statistics_src, heatmaps=heatmaps), code='''
+    const measure = cb_obj.value.toLowerCase();
+    source.data['correlation'] = source.data['correlation_' + measure];
+    source.data['slope'] = source.data['slope_' + measure];
+    source.change.emit();
+    for (const heatmap of heatmaps) {
+        heatmap.title.text = heatmap.title.text.replace(/with \\w+/, 'with ' + measure);
+    }
+'''))
+if not static:
+    age_choice.on_change('value', lambda attr, old, new: show_statistics())
+    level_choice.on_change('value', lambda attr, old, new: show_statistics())
+
+
+def check_dataset():
+    # Picks up the dataset the server swapped in after the data files changed, the widgets keep their choices
+    # where the new data still has them
+    global dataset, years
+    current = get_dataset()
+    if current is dataset:
+        return
+    dataset, years = current, current.years
+
+    country_choice.options = dataset.countries
+    country_choice.value = [country for country in country_choice.value if country in dataset.country_codes]
+    for choice, options in [(age_choice, dataset.ages), (level_choice, dataset.levels)]:
+        choice.options = options
+        if choice.value not in options:
+            choice.value = options[0]
+    year_slider.start, year_slider.end = years[0], years[-1]
+    year_slider.value = min(max(year_slider.value, years[0]), years[-1])
+    for heatmap in heatmaps:
+        heatmap.x_range.start, heatmap.x_range.end = years[0] - 0.5, years[-1] + 0.5
+
+    update_axis()
+    show_statistics()
+    request_frame()
+
+
+if not static and reload_interval and doc.session_context is not None:
+    doc.add_periodic_callback(check_dataset, reload_interval * 1000)
 
 # Initialise the process
 update()
+show_statistics()
+
+if static:
+    # The page holds the default age group and level, rows are counted from the start of their block
+    start, stop = dataset.block_rows.get((age_choice.value, level_choice.value), (0, 0))
+    rows, previous = dataset.country_rows(country_list, age=age_choice.value)
+    shown = (rows >= start) & (rows < stop)
+    previous_row = np.zeros(stop - start, dtype=np.int32)
+    previous_row[rows[shown] - start] = previous[shown] - start
+    frame_src.data.update({column: dataset.risk_column(column)[start:stop] for column in risk_map.values()})
+    frame_src.data.update(previous=previous_row, x0=frame_src.data['x'][previous_row],
+                          y0=frame_src.data['y'][previous_row])
+
+# Age groups and location levels are picked on the server, the static page only holds the defaults
+# The uncertainty overlay is sliced on the server as well
+choices = [[country_choice, x_name]] if static else [[country_choice, x_name], [age_choice, level_choice, overlay]]
 
 layout = layout([
     [plot],
     [year_slider, button],
-    [country_choice, x_name]
+] + choices + [
+    [statistics_measure],
+    heatmaps,
 ], sizing_mode='scale_width', name='layout')
 
 curdoc().add_root(layout)
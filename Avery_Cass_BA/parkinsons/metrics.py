@@ -0,0 +1,240 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Opt-in instrumentation of the widget callbacks, enabled by setting PARKINSONS_METRICS=1
+
+Every session records wall time per callback and per stage of update(), the rows it sliced, the playback frames it
+dropped and the bytes of the document patches sent to its browser. server_lifecycle logs one JSON line per session every
+PARKINSONS_METRICS_INTERVAL seconds (60 by default) on the 'parkinsons.metrics' logger, then starts a new interval.
+
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+enabled = os.environ.get('PARKINSONS_METRICS', '') not in ('', '0')
+log_interval = float(os.environ.get('PARKINSONS_METRICS_INTERVAL', 60))
+
+# bokeh serve only sets the level of its own loggers, the lines are logged at INFO whatever the root level
+log = logging.getLogger('parkinsons.metrics')
+if enabled:
+    log.setLevel(logging.INFO)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def patch_size(events):
+    '''
+    Measures the PATCH-DOC message the server would send for a list of document change events
+    :param events: list of bokeh DocumentChangedEvent, those that are not sent to the browser are left out
+    :return: size in bytes of the message content and binary buffers
+    '''
+    from bokeh.document.events import DocumentPatchedEvent
+    from bokeh.protocol.messages.patch_doc import process_document_events
+    events = [event for event in events if isinstance(event, DocumentPatchedEvent)]
+    if not events:
+        return 0
+    content, buffers = process_document_events(events, use_buffers=True)
+    return len(content.encode('utf-8')) + sum(len(json.dumps(header)) + len(payload) for header, payload in buffers)
+
+
+def message_size(message):
+    '''
+    :param message: bokeh protocol Message that was sent, so its JSON fragments are already serialized
+    :return: size in bytes of the message content and binary buffers
+    '''
+    return (len(message.header_json) + len(message.metadata_json) + len(message.content_json)
+            + sum(len(json.dumps(header)) + len(payload) for header, payload in message.buffers))
+
+
+class SessionMetrics(object):
+    '''
+    Counters for one session, reset each time they are logged
+    '''
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.rows = 0
+        self.skipped_frames = 0
+        self.bytes = 0
+        self.patches = 0
+        self.started = time.time()
+
+    def record(self, name, seconds):
+        '''
+        Adds one timing to the count, total and maximum kept for name
+        :param name: callback or stage name
+        :param seconds: wall time in seconds
+        '''
+        with self._lock:
+            count, total, longest = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name, callback):
+        '''
+        Wraps a bokeh callback so each call is recorded under name, keeping its signature for bokeh's checks
+        :param name: name to record the callback under, e.g. 'year_slider'
+        :param callback: function called by bokeh
+        :return: the wrapped function
+        '''
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return callback(*args, **kwargs)
+        return wrapper
+
+    def touched(self, rows):
+        with self._lock:
+            self.rows += rows
+
+    def skipped(self):
+        with self._lock:
+            self.skipped_frames += 1
+
+    def sent(self, size, seconds):
+        '''
+        Counts one PATCH-DOC message written to the browser of the session
+        :param size: size in bytes of the message content and binary buffers
+        :param seconds: wall time from the start of the write until the websocket took the whole message
+        '''
+        self.record('send', seconds)
+        with self._lock:
+            self.bytes += size
+            self.patches += 1
+
+    def snapshot(self, reset=True):
+        '''
+        :param reset: start a new interval afterwards
+        :return: dict of the counters since the last reset, timings in milliseconds
+        '''
+        with self._lock:
+            line = {
+                'event': 'parkinsons.metrics',
+                'session': self.session_id,
+                'interval_s': round(time.time() - self.started, 3),
+                'timings': {name: {'count': count,
+                                   'total_ms': round(total * 1000, 3),
+                                   'max_ms': round(longest * 1000, 3)}
+                            for name, (count, total, longest) in sorted(self.timings.items())},
+                'rows': self.rows,
+                'skipped_frames': self.skipped_frames,
+                'bytes': self.bytes,
+                'patches': self.patches,
+            }
+            if reset:
+                self.reset()
+        return line
+
+
+class NullMetrics(object):
+    '''
+    Stands in for SessionMetrics when instrumentation is off, so the callbacks run unwrapped
+    '''
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def timed(self, name, callback):
+        return callback
+
+    def touched(self, rows):
+        pass
+
+    def skipped(self):
+        pass
+
+
+_null = NullMetrics()
+
+
+def session_metrics(doc):
+    '''
+    Returns the metrics for the session owning doc, registering the session on first use
+    :param doc: bokeh Document of the session
+    :return: SessionMetrics, or NullMetrics when PARKINSONS_METRICS is not set
+    '''
+    if not enabled:
+        return _null
+
+    context = doc.session_context
+    session_id = context.id if context is not None else str(id(doc))
+    with _sessions_lock:
+        metrics = _sessions.get(session_id)
+        if metrics is None:
+            metrics = _sessions[session_id] = SessionMetrics(session_id)
+    return metrics
+
+
+def count_sent_patches():
+    '''
+    Wraps the websocket handler of bokeh serve so every PATCH-DOC message is counted as it is sent, its size read off
+    the JSON the message serialized for the write rather than serialized a second time
+    Called once per process from server_lifecycle.on_server_loaded
+    '''
+    from bokeh.server.views.ws import WSHandler
+    send_message = WSHandler.send_message
+    if getattr(send_message, 'counted', False):
+        return
+
+    @wraps(send_message)
+    def counted(handler, message):
+        start = time.perf_counter()
+        sending = send_message(handler, message)
+        connection = handler.connection
+        if message.msgtype == 'PATCH-DOC' and connection is not None and connection.session is not None:
+            with _sessions_lock:
+                metrics = _sessions.get(connection.session.id)
+            if metrics is not None:
+                sending.add_done_callback(
+                    lambda future: metrics.sent(message_size(message), time.perf_counter() - start))
+        return sending
+
+    counted.counted = True
+    WSHandler.send_message = counted
+
+
+def log_metrics():
+    '''
+    Logs one JSON line per session with activity since the last call
+    '''
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    for metrics in sessions:
+        _log(metrics.snapshot())
+
+
+def end_session(session_id):
+    '''
+    Logs the last interval of a session and forgets it
+    :param session_id: id of the destroyed session
+    '''
+    with _sessions_lock:
+        metrics = _sessions.pop(session_id, None)
+    if metrics is not None:
+        _log(metrics.snapshot())
+
+
+def _log(line):
+    if line['timings']:
+        log.info(json.dumps(line, sort_keys=True))
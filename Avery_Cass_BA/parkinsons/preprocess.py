@@ -0,0 +1,46 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Builds the year-partitioned store that the app memory-maps instead of parsing the IHME exports on start-up
+
+Usage:
+    python preprocess.py
+    python preprocess.py --data-dir path/to/exports --store path/to/store
+
+The app reads the same directories as preprocess.py, PARKINSONS_DATA_DIR and PARKINSONS_STORE when set and
+parkinsons/data and parkinsons/data/store otherwise, so a store built elsewhere is served with e.g.
+
+    PARKINSONS_DATA_DIR=path/to/exports PARKINSONS_STORE=path/to/store bokeh serve parkinsons
+
+Run it after dropping new exports into the data directory. The app also rebuilds the store itself when it finds
+a source file changed, at start-up or every PARKINSONS_RELOAD_INTERVAL seconds (5 by default) while running, but
+building it offline keeps that work out of the server. Only exports whose content changed are parsed again.
+
+"""
+
+import argparse
+import time
+
+from data import build_store, data_dir, store_dir, store_lock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=data_dir,
+                        help='directory holding the IHME exports and region.csv, the one the app reads by default')
+    parser.add_argument('--store', default=store_dir,
+                        help='directory to write the store to, the one the app reads by default')
+    args = parser.parse_args()
+
+    start = time.time()
+    with store_lock(args.store):
+        manifest = build_store(args.data_dir, args.store)
+
+    rows = max([stop for _, _, _, _, stop in manifest['frame_rows']], default=0)
+    years = {year for _, _, year, _, _ in manifest['frame_rows']}
+    print('Wrote %d rows over %d years to %s in %.1fs' % (rows, len(years), args.store, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
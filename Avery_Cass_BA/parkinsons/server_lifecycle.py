@@ -0,0 +1,35 @@
+"""
+Author: Avery Soh
+Email: averysoh@outlook.com
+
+Server lifecycle hooks, run once per `bokeh serve` process rather than once per session
+
+"""
+
+import metrics
+from data import get_dataset, reload_interval, SourceWatcher
+
+
+def on_server_loaded(server_context):
+    '''
+    Builds the shared dataset and its indexes before the first session is created, starts watching the data files
+    for changes and, when PARKINSONS_METRICS is set, starts logging the session metrics
+    :param server_context: bokeh ServerContext
+    '''
+    get_dataset()
+
+    if reload_interval:
+        server_context.add_periodic_callback(SourceWatcher().poll, reload_interval * 1000)
+
+    if metrics.enabled:
+        metrics.count_sent_patches()
+        server_context.add_periodic_callback(metrics.log_metrics, metrics.log_interval * 1000)
+
+
+def on_session_destroyed(session_context):
+    '''
+    Logs the last metrics of a closed session
+    :param session_context: bokeh SessionContext
+    '''
+    if metrics.enabled:
+        metrics.end_session(session_context.id)